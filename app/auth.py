@@ -1,15 +1,18 @@
+import asyncio
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from dotenv import load_dotenv
 
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 
 from sqlalchemy.orm import Session
 from .database import get_db
+from .cache import TTLCache
+from .metrics import BCRYPT_SECONDS, counter_func
 from . import crud
 
 load_dotenv()
@@ -21,16 +24,70 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_PASSWORD_HASHED = os.getenv("ADMIN_PASSWORD_HASHED")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt is CPU bound; a dedicated, bounded pool keeps a burst of logins from
+# occupying every threadpool worker that the DB calls also need.
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(os.cpu_count() or 1)))
+
+# Validated tokens and (username -> room_id) identities are cached so the
+# authenticated read endpoints skip the per-request room lookup.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = int(os.getenv("TOKEN_CACHE_TTL_SECONDS", "60"))
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+_bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS)
+identity_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS)
+
+# passlib with its bcrypt backend and jose are imported on first use rather
+# than with this module, which keeps them off worker startup and out of the
+# CLIs that never check a password. preload() loads them in the background.
+_pwd_context = None
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        # passlib picks the bcrypt backend on the first hash; do it here.
+        context.handler("bcrypt").get_backend()
+        _pwd_context = context
+    return _pwd_context
+
+def preload():
+    """Loads the JWT and password libraries on the bcrypt pool, without waiting."""
+    def load():
+        # jose first: every authenticated request needs it, passlib only logins.
+        import jose.jwt  # noqa: F401
+        get_pwd_context()
+    _bcrypt_executor.submit(load)
+
+def _timed_hash(password: str) -> str:
+    context = get_pwd_context()
+    with BCRYPT_SECONDS.time("hash"):
+        return context.hash(password)
+
+def _timed_verify(plain_password: str, hashed_password: str) -> bool:
+    context = get_pwd_context()
+    with BCRYPT_SECONDS.time("verify"):
+        return context.verify(plain_password, hashed_password)
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return _bcrypt_executor.submit(_timed_hash, password).result()
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return _bcrypt_executor.submit(_timed_verify, plain_password, hashed_password).result()
+
+async def hash_password_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_bcrypt_executor, _timed_hash, password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(
+        _bcrypt_executor, _timed_verify, plain_password, hashed_password
+    )
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    from jose import jwt
+
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
@@ -46,6 +103,13 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    token_key = hashlib.sha256(token.encode()).hexdigest()
+    cached = token_cache.get(token_key)
+    if cached is not None:
+        return dict(cached)
+
+    from jose import JWTError, jwt
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -58,8 +122,18 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         if user_role == "user":
             if user_room_id is None:
                 raise credentials_exception
-            user = crud.get_room_by_username(db, username)
-            if user is None or user.id != user_room_id:
+            room_id = identity_cache.get(username)
+            if room_id is None:
+                try:
+                    user = crud.get_room_by_username(db, username)
+                finally:
+                    # Release the connection; the route takes a fresh one if it needs it.
+                    db.close()
+                if user is None:
+                    raise credentials_exception
+                room_id = user.id
+                identity_cache.set(username, room_id)
+            if room_id != user_room_id:
                 raise credentials_exception
         elif user_role == "admin":
             if username != ADMIN_USERNAME:
@@ -67,14 +141,32 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         else:
             raise credentials_exception
 
-        return {"username": username, "role": user_role, "room_id": user_room_id}
+        current_user = {"username": username, "role": user_role, "room_id": user_room_id}
+        token_cache.set(token_key, current_user, expires_at=payload.get("exp"))
+        return dict(current_user)
     except JWTError:
         raise credentials_exception
 
+def invalidate_room(username: str):
+    # Call when a room is deleted or renamed so cached tokens stop resolving to it.
+    identity_cache.pop(username)
+    token_cache.pop_where(lambda current_user: current_user["username"] == username)
+
+def get_cache_stats() -> dict:
+    return {"token": token_cache.stats(), "identity": identity_cache.stats()}
+
+counter_func("auth_cache_hits_total", "Auth cache hits by cache.", ("cache",),
+             collect=lambda: [(("token",), token_cache.hits), (("identity",), identity_cache.hits)])
+counter_func("auth_cache_misses_total", "Auth cache misses by cache.", ("cache",),
+             collect=lambda: [(("token",), token_cache.misses), (("identity",), identity_cache.misses)])
+
 async def get_current_admin_user(current_user_data: dict = Depends(get_current_user)):
     if current_user_data["role"] != "admin":
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized as admin")
     return current_user_data["username"]
 
 def verify_admin_password(plain_password: str):
-    return verify_password(plain_password, ADMIN_PASSWORD_HASHED)
\ No newline at end of file
+    return verify_password(plain_password, ADMIN_PASSWORD_HASHED)
+
+async def verify_admin_password_async(plain_password: str):
+    return await verify_password_async(plain_password, ADMIN_PASSWORD_HASHED)
\ No newline at end of file
@@ -1,7 +1,12 @@
+import heapq
+from datetime import datetime
+from itertools import chain
+from typing import List, Optional, Tuple
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import delete, desc, func, insert, select, text, update, bindparam, or_, and_, tuple_, union_all
 from . import models, schemas
 from .auth import hash_password, verify_password
+from .response_cache import response_cache
 
 def get_room_by_username(db: Session, username: str):
     return db.query(models.Room).filter(models.Room.username == username).first()
@@ -9,40 +14,401 @@ def get_room_by_username(db: Session, username: str):
 def get_room_by_id(db: Session, room_id: str):
     return db.query(models.Room).filter(models.Room.id == room_id).first()
 
+def get_existing_room_ids(db: Session, room_ids: List[str]) -> List[str]:
+    return list(db.scalars(select(models.Room.id).where(models.Room.id.in_(room_ids))))
+
 def create_room(db: Session, room: schemas.RoomCreate):
     hashed_password = hash_password(room.password)
     db_room = models.Room(username=room.username, password=hashed_password)
     db.add(db_room)
     db.commit()
+    if response_cache is not None:
+        response_cache.bump_global()
     db.refresh(db_room)
     return db_room
 
-def get_all_rooms_summary(db: Session):
-    rooms = db.query(models.Room).all()
-    summaries = []
-    for room in rooms:
-        last_message = db.query(models.Message)\
-                         .filter(models.Message.room_id == room.id)\
-                         .order_by(desc(models.Message.timestamp))\
-                         .first()
-        summary = schemas.AdminRoomSummary(
-            id=room.id,
-            username=room.username,
-            last_message_content=last_message.content if last_message else None,
-            last_message_timestamp=last_message.timestamp if last_message else None
+def get_all_rooms_summary(db: Session, skip: int = 0, limit: Optional[int] = None):
+    # Reads the last message kept on each room (see update_room_last_messages),
+    # in the order of ix_rooms_last_message_at, so a page costs the same at
+    # any message count.
+    query = db.query(models.Room.id, models.Room.username, models.Room.last_message_preview, models.Room.last_message_at)\
+              .order_by(models.Room.last_message_at.desc().nulls_last(), models.Room.username)\
+              .offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+
+    return [
+        schemas.AdminRoomSummary(
+            id=room_id,
+            username=username,
+            last_message_content=content,
+            last_message_timestamp=timestamp
         )
-        summaries.append(summary)
-    return summaries
+        for room_id, username, content, timestamp in query.all()
+    ]
+
+def _newer_than_room_last_message(timestamp, message_id):
+    # A room's last message only moves forward in (timestamp, id), so writers
+    # that commit out of order, and rows older than what the room already
+    # has, leave it alone.
+    last_at = models.Room.last_message_at
+    return or_(
+        last_at.is_(None),
+        last_at < timestamp,
+        and_(last_at == timestamp, models.Room.last_message_id < message_id),
+    )
+
+def _set_room_last_messages(db: Session, rows: List[dict]):
+    # rows hold "room", "message_id", "at" and "preview".
+    db.execute(
+        update(models.Room.__table__)
+        .where(models.Room.id == bindparam("room"),
+               _newer_than_room_last_message(bindparam("at"), bindparam("message_id")))
+        .values(last_message_id=bindparam("message_id"), last_message_at=bindparam("at"),
+                last_message_preview=bindparam("preview")),
+        rows,
+    )
+
+def update_room_last_messages(db: Session, messages: List[dict]):
+    """Points each room at the newest of the given message rows. The caller commits."""
+    newest = {}
+    for message in messages:
+        current = newest.get(message["room_id"])
+        if current is None or (message["timestamp"], message["id"]) > (current["timestamp"], current["id"]):
+            newest[message["room_id"]] = message
+    if newest:
+        _set_room_last_messages(db, [
+            {"room": room_id, "message_id": message["id"], "at": message["timestamp"], "preview": message["content"]}
+            for room_id, message in newest.items()
+        ])
+
+STREAM_CHUNK_SIZE = 1000
+
+# Keyset pagination on (timestamp, id), matching ix_messages_timestamp_id and,
+# within a room, ix_messages_room_id_timestamp_id. The cursor message's
+# timestamp is looked up first, so the page itself is a plain row-value range
+# on the index; the cursor may be a hot or an archived message. A cursor that
+# names no message (after_id=0 to start from the beginning, or a message that
+# was deleted) is compared on id alone.
+Cursor = Tuple[Optional[datetime], int]
+
+def _resolve_cursor(db: Session, cursor_id: Optional[int]) -> Optional[Cursor]:
+    if cursor_id is None:
+        return None
+    timestamp = db.scalar(select(func.coalesce(
+        select(models.Message.timestamp).where(models.Message.id == cursor_id).scalar_subquery(),
+        select(models.ArchivedMessage.timestamp).where(models.ArchivedMessage.id == cursor_id).scalar_subquery(),
+    )))
+    return timestamp, cursor_id
+
+def _messages_before(query, cursor: Cursor, model=models.Message):
+    timestamp, cursor_id = cursor
+    if timestamp is None:
+        return query.filter(model.id < cursor_id)
+    return query.filter(tuple_(model.timestamp, model.id) < (timestamp, cursor_id))
+
+def _messages_after(query, cursor: Cursor, model=models.Message):
+    timestamp, cursor_id = cursor
+    if timestamp is None:
+        return query.filter(model.id > cursor_id)
+    return query.filter(tuple_(model.timestamp, model.id) > (timestamp, cursor_id))
+
+def _paginate_messages(query, before: Optional[Cursor] = None, after: Optional[Cursor] = None,
+                       limit: Optional[int] = None, model=models.Message):
+    if before is not None:
+        query = _messages_before(query, before, model)
+    if after is not None:
+        query = _messages_after(query, after, model)
+
+    if after is None and limit is not None:
+        # Newest page (before the cursor, if any), returned oldest-first.
+        messages = query.order_by(desc(model.timestamp), desc(model.id)).limit(limit).all()
+        messages.reverse()
+        return messages
+
+    query = query.order_by(model.timestamp, model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+MESSAGE_COLUMNS = ("id", "room_id", "sender", "content", "timestamp", "seq")
+
+def _paginate_with_archive(db: Session, room_id: Optional[str], before_id: Optional[int] = None,
+                           after_id: Optional[int] = None, limit: Optional[int] = None):
+    # Within a room, archived messages are older than every hot message, so
+    # the archive continues a page once the hot table runs out: before hot
+    # results when paging forwards, after them when paging backwards. Pages
+    # that the hot table fills on its own never touch the archive.
+    before, after = _resolve_cursor(db, before_id), _resolve_cursor(db, after_id)
+    if room_id is None:
+        # Across rooms a busy room's archive can be newer than a quiet room's
+        # hot messages, so both tables are paged on their own (timestamp, id)
+        # index and the two pages are merged here.
+        merged = list(heapq.merge(
+            _paginate_messages(db.query(models.ArchivedMessage), before=before, after=after, limit=limit,
+                               model=models.ArchivedMessage),
+            _paginate_messages(db.query(models.Message), before=before, after=after, limit=limit),
+            key=_message_order,
+        ))
+        if limit is None:
+            return merged
+        return merged[:limit] if after is not None else merged[-limit:]
+
+    hot = db.query(models.Message).filter(models.Message.room_id == room_id)
+    archive = db.query(models.ArchivedMessage).filter(models.ArchivedMessage.room_id == room_id)
+
+    if after is not None:
+        older = _paginate_messages(archive, after=after, limit=limit, model=models.ArchivedMessage)
+        if limit is not None and len(older) >= limit:
+            return older
+        remaining = None if limit is None else limit - len(older)
+        return older + _paginate_messages(hot, after=after, limit=remaining)
+
+    messages = _paginate_messages(hot, before=before, limit=limit)
+    if limit is not None and len(messages) >= limit:
+        return messages
+    remaining = None if limit is None else limit - len(messages)
+    return _paginate_messages(archive, before=before, limit=remaining, model=models.ArchivedMessage) + messages
+
+def _message_order(message):
+    return message.timestamp, message.id
+
+def _stream_messages(query, after: Optional[Cursor] = None, model=models.Message):
+    if after is not None:
+        query = _messages_after(query, after, model)
+    return query.order_by(model.timestamp, model.id).yield_per(STREAM_CHUNK_SIZE)
+
+def _stream_with_archive(db: Session, room_id: Optional[str], after_id: Optional[int] = None):
+    after = _resolve_cursor(db, after_id)
+    if room_id is None:
+        return heapq.merge(
+            _stream_messages(db.query(models.ArchivedMessage), after=after, model=models.ArchivedMessage),
+            _stream_messages(db.query(models.Message), after=after),
+            key=_message_order,
+        )
+
+    hot = db.query(models.Message).filter(models.Message.room_id == room_id)
+    archive = db.query(models.ArchivedMessage).filter(models.ArchivedMessage.room_id == room_id)
+    return chain(
+        _stream_messages(archive, after=after, model=models.ArchivedMessage),
+        _stream_messages(hot, after=after),
+    )
+
+def get_messages_by_room_id(db: Session, room_id: str, before_id: Optional[int] = None, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return _paginate_with_archive(db, room_id, before_id=before_id, after_id=after_id, limit=limit)
+
+def get_latest_messages_by_room_id(db: Session, room_id: str, limit: int):
+    return _paginate_with_archive(db, room_id, limit=limit)
 
-def get_messages_by_room_id(db: Session, room_id: str):
-    return db.query(models.Message).filter(models.Message.room_id == room_id).order_by(models.Message.timestamp).all()
+def iter_messages_by_room_id(db: Session, room_id: str, after_id: Optional[int] = None):
+    return _stream_with_archive(db, room_id, after_id=after_id)
+
+def get_messages_since_seq(db: Session, room_id: str, since_seq: int, limit: Optional[int] = None):
+    messages = []
+    # Only a client that is behind the hot window needs the archive.
+    for model in (models.ArchivedMessage, models.Message):
+        query = db.query(model).filter(model.room_id == room_id, model.seq > since_seq).order_by(model.seq)
+        if limit is not None:
+            query = query.limit(limit - len(messages))
+        messages += query.all()
+        if limit is not None and len(messages) >= limit:
+            break
+    return messages
+
+def warm_queries(db: Session):
+    # Runs the hot read paths once for a room id that cannot exist, so their
+    # SQL is compiled and in the engine's statement cache before the first
+    # request. Each is an index lookup that finds nothing.
+    missing = ""
+    get_room_by_id(db, missing)
+    get_room_by_username(db, missing)
+    get_room_last_seq(db, missing)
+    get_latest_messages_by_room_id(db, missing, 1)
+    get_messages_by_room_id(db, missing, before_id=0, limit=1)
+    get_messages_by_room_id(db, missing, after_id=0, limit=1)
+    get_messages_since_seq(db, missing, 0, limit=1)
+
+def get_message_changes(db: Session, since_id: int, limit: int, settled_before: datetime):
+    # Delta feed across all rooms, keyed on the global message id. Ids are
+    # taken before commit, so a lower id can still become visible after a
+    # higher one. The page therefore stops at the first gap in the ids
+    # while the row after it is newer than settled_before: the missing id
+    # may belong to a transaction that has not committed yet. Older gaps
+    # are rolled-back, deleted or archived ids and are passed over.
+    # Returns the messages and whether more are ready right away.
+    messages = db.query(models.Message)\
+                 .filter(models.Message.id > since_id)\
+                 .order_by(models.Message.id)\
+                 .limit(limit + 1)\
+                 .all()
+    previous_id = since_id
+    for index, message in enumerate(messages[:limit]):
+        if message.id != previous_id + 1 and message.timestamp > settled_before:
+            return messages[:index], False
+        previous_id = message.id
+    return messages[:limit], len(messages) > limit
+
+def next_room_seq(db: Session, room_id: str) -> int:
+    # The row lock taken by the UPDATE serializes writers in the same room
+    # until the caller commits.
+    return db.execute(
+        update(models.Room)
+        .where(models.Room.id == room_id)
+        .values(last_seq=models.Room.last_seq + 1)
+        .returning(models.Room.last_seq)
+    ).scalar_one()
+
+def get_room_seqs(db: Session):
+    return db.query(models.Room.id, models.Room.last_seq).all()
+
+def get_room_last_seq(db: Session, room_id: str) -> int:
+    return db.query(models.Room.last_seq).filter(models.Room.id == room_id).scalar() or 0
 
 def create_message(db: Session, message: schemas.MessageCreate):
-    db_message = models.Message(**message.model_dump())
+    db_message = models.Message(**message.model_dump(), seq=next_room_seq(db, message.room_id))
     db.add(db_message)
+    db.flush()
+    _set_room_last_messages(db, [{"room": db_message.room_id, "message_id": db_message.id,
+                                  "at": db_message.timestamp, "preview": db_message.content}])
     db.commit()
+    # The caller bumps the room's cached responses once the message is in
+    # the recent message buffer too; see persistence.save_and_encode_message.
     db.refresh(db_message)
     return db_message
 
-def get_all_messages(db: Session):
-    return db.query(models.Message).order_by(models.Message.timestamp).all()
\ No newline at end of file
+def bulk_create_messages(db: Session, messages: List[dict]):
+    # One executemany INSERT and one commit for the whole batch. Rows carry
+    # their own pre-assigned ids (see reserve_message_ids) and seqs, and the
+    # rooms' last_seq counters are moved up to match in the same transaction.
+    if not messages:
+        return
+    db.execute(insert(models.Message), messages)
+    last_seqs = {}
+    for message in messages:
+        last_seqs[message["room_id"]] = max(last_seqs.get(message["room_id"], 0), message["seq"])
+    db.execute(
+        update(models.Room.__table__)
+        .where(models.Room.id == bindparam("room"), models.Room.last_seq < bindparam("seq"))
+        .values(last_seq=bindparam("seq")),
+        [{"room": room_id, "seq": seq} for room_id, seq in last_seqs.items()],
+    )
+    update_room_last_messages(db, messages)
+    db.commit()
+    if response_cache is not None:
+        response_cache.bump(*last_seqs)
+
+def get_max_message_id(db: Session) -> int:
+    return db.query(func.max(models.Message.id)).scalar() or 0
+
+def reserve_message_ids(db: Session, count: int) -> List[int]:
+    # PostgreSQL only: draws ids from the messages.id serial sequence, so they
+    # never collide with rows inserted by other workers.
+    result = db.execute(
+        text("SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, :count)"),
+        {"count": count},
+    )
+    ids = [row[0] for row in result]
+    db.commit()
+    return ids
+
+def get_all_messages(db: Session, before_id: Optional[int] = None, after_id: Optional[int] = None, limit: Optional[int] = None):
+    return _paginate_with_archive(db, None, before_id=before_id, after_id=after_id, limit=limit)
+
+def iter_all_messages(db: Session, after_id: Optional[int] = None):
+    return _stream_with_archive(db, None, after_id=after_id)
+
+def archive_room_messages(db: Session, room_id: str, cutoff: Optional[datetime] = None,
+                          max_seq: Optional[int] = None, batch_size: int = 1000) -> int:
+    """Moves one batch of the room's oldest messages that are older than
+    cutoff or have seq <= max_seq into the archive. Returns how many moved.
+
+    The globally newest message is never moved: SQLite numbers new rows from
+    MAX(id) + 1 and would otherwise reissue an archived id.
+    """
+    conditions = []
+    if cutoff is not None:
+        conditions.append(models.Message.timestamp < cutoff)
+    if max_seq is not None:
+        conditions.append(models.Message.seq <= max_seq)
+    if not conditions:
+        return 0
+
+    newest_id = select(func.max(models.Message.id)).scalar_subquery()
+    ids = db.execute(
+        select(models.Message.id)
+        .where(models.Message.room_id == room_id, models.Message.id < newest_id, or_(*conditions))
+        .order_by(models.Message.timestamp, models.Message.id)
+        .limit(batch_size)
+    ).scalars().all()
+    if not ids:
+        return 0
+
+    db.execute(
+        insert(models.ArchivedMessage).from_select(
+            MESSAGE_COLUMNS,
+            select(*[getattr(models.Message, column) for column in MESSAGE_COLUMNS]).where(models.Message.id.in_(ids)),
+        )
+    )
+    db.execute(delete(models.Message).where(models.Message.id.in_(ids)).execution_options(synchronize_session=False))
+    db.commit()
+    # History pages and the room's last message are unchanged, so cached
+    # responses stay valid.
+    return len(ids)
+
+def iter_table_rows(db: Session, model, columns: List[str]):
+    # Streams plain rows in primary key order through a server-side cursor.
+    statement = select(*[getattr(model, column) for column in columns])\
+                    .order_by(model.id)\
+                    .execution_options(yield_per=STREAM_CHUNK_SIZE)
+    return db.execute(statement).mappings()
+
+def bulk_insert_rows(db: Session, model, rows: List[dict]):
+    # executemany needs the same keys in every row, so rows that leave the id
+    # to the database go in a statement of their own. The caller commits.
+    with_id = [row for row in rows if "id" in row]
+    without_id = [row for row in rows if "id" not in row]
+    for group in (with_id, without_id):
+        if group:
+            db.execute(insert(model.__table__), group)
+
+def sync_room_last_seqs(db: Session):
+    # Moves each room's counter past seqs written directly, e.g. by an import.
+    for model in (models.Message, models.ArchivedMessage):
+        max_seq = select(func.max(model.seq)).where(model.room_id == models.Room.id).scalar_subquery()
+        db.execute(
+            update(models.Room.__table__)
+            .where(models.Room.last_seq < func.coalesce(max_seq, 0))
+            .values(last_seq=max_seq)
+        )
+
+def sync_room_last_messages(db: Session):
+    # Points every room at its newest hot or archived message, after rows
+    # were written directly, e.g. by an import.
+    candidates = union_all(*[
+        select(model.room_id, model.id, model.timestamp, model.content)
+        for model in (models.Message, models.ArchivedMessage)
+    ]).subquery()
+    latest = select(
+        candidates,
+        func.row_number().over(
+            partition_by=candidates.c.room_id,
+            order_by=(desc(candidates.c.timestamp), desc(candidates.c.id)),
+        ).label("rank"),
+    ).subquery()
+    db.execute(
+        update(models.Room.__table__)
+        .where(models.Room.id == latest.c.room_id, latest.c.rank == 1,
+               _newer_than_room_last_message(latest.c.timestamp, latest.c.id))
+        .values(last_message_id=latest.c.id, last_message_at=latest.c.timestamp,
+                last_message_preview=latest.c.content)
+    )
+
+def sync_message_id_sequence(db: Session):
+    # PostgreSQL only: rows inserted with explicit ids leave the serial
+    # sequence behind. SQLite always continues from MAX(id).
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    db.execute(text(
+        "SELECT setval(pg_get_serial_sequence('messages', 'id'), GREATEST("
+        "(SELECT COALESCE(MAX(id), 0) FROM messages), (SELECT COALESCE(MAX(id), 0) FROM messages_archive), 1))"
+    ))
@@ -1,20 +1,106 @@
 # app/database.py
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from fastapi.concurrency import run_in_threadpool
+from .metrics import DB_QUERY_SECONDS
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
 
 if not SQLALCHEMY_DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set. Please check your .env file.")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    pool_recycle=3600
-)
+# Optional read replica for the read-only history and admin queries. Falls
+# back to the primary when unset.
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+# PostgreSQL only; 0 leaves the server default in place.
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# SQLite only: WAL lets readers proceed while a write is in progress.
+SQLITE_WAL = os.getenv("SQLITE_WAL", "true").lower() in ("1", "true", "yes")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Apply pending migrations at startup. With false, workers only check the
+# schema version and refuse to start if it is behind; run migrate.py first.
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "true").lower() in ("1", "true", "yes")
+# Connections opened per engine at startup rather than on the first requests.
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", str(DB_POOL_SIZE)))
+
+
+def _engine_options(url) -> dict:
+    options = {"pool_recycle": DB_POOL_RECYCLE, "pool_pre_ping": DB_POOL_PRE_PING}
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        # Sessions are used from threadpool workers other than the one that
+        # opened the connection.
+        options["connect_args"] = {"check_same_thread": False}
+        if url.database in (None, "", ":memory:"):
+            # In-memory databases get a single-connection pool without sizing.
+            return options
+    elif backend == "postgresql" and DB_STATEMENT_TIMEOUT_MS > 0:
+        options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+# The start time lives on the execution context, which is discarded with the
+# statement, so a statement that raises leaves nothing behind. Executions
+# without a context (column default and sequence prefetches) are not timed.
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+def _record_query_time(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    DB_QUERY_SECONDS.observe(elapsed, operation)
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    if SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def make_engine(database_url: str):
+    url = make_url(database_url)
+    new_engine = create_engine(url, **_engine_options(url))
+    event.listen(new_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(new_engine, "after_cursor_execute", _record_query_time)
+    if url.get_backend_name() == "sqlite":
+        event.listen(new_engine, "connect", _configure_sqlite_connection)
+    return new_engine
+
+
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
+replica_engine = make_engine(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else engine
+
+def warm_pool(target_engine, size: int = DB_POOL_WARMUP):
+    # Checked out together so the pool really holds size connections, each
+    # already through connect and the SQLite pragmas.
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(target_engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
 
 Base = declarative_base()
 
@@ -26,16 +112,31 @@ def get_db():
     finally:
         db.close()
 
+# Same as get_db, for routes that only call read-only crud functions. Reads
+# may lag the primary by the replica's replication delay.
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Run a blocking crud call in the threadpool and hand the pooled connection back
+# before returning. A request never holds a connection while it waits for a
+# worker thread, so a full threadpool cannot deadlock against the pool.
+async def run_db(fn, db, *args, **kwargs):
+    def call():
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+    return await run_in_threadpool(call)
+
 # --- TAMBAHKAN FUNGSI INI DI SINI ---
 def create_db_and_tables():
-    # Import models here to ensure they are registered with Base.metadata
-    # Contoh: Jika models.py Anda mendefinisikan tabel seperti Room dan Message
-    # Anda perlu memastikan models.py diimpor *sebelum* create_all dipanggil.
-    # Biasanya, Anda akan mengimpor `models` di main.py, dan itu cukup.
-    # Tapi untuk memastikan, kita bisa impor di sini juga jika diperlukan.
-
-    # Contoh import jika models.py ada di folder app
-    from . import models 
+    # Applies any pending schema migrations (see app/migrations.py). The name
+    # is kept for the CLIs and scripts that call it before touching the DB.
+    from . import migrations
 
-    Base.metadata.create_all(bind=engine)
-# --- AKHIR PENAMBAHAN ---
\ No newline at end of file
+    return migrations.upgrade(engine)
+# --- AKHIR PENAMBAHAN ---
@@ -1,22 +1,78 @@
+import io
+import logging
 import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
 
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import JSONResponse
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger(__name__)
+
+from fastapi import FastAPI, Depends, HTTPException, Request, status, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from pydantic import TypeAdapter
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List, Union 
+from typing import List, Optional, Union 
 
-from .database import get_db, create_db_and_tables
-from . import schemas, crud, auth
+from .database import (get_db, get_read_db, create_db_and_tables, engine, replica_engine, warm_pool,
+                       DB_AUTO_MIGRATE, ReadSessionLocal, run_db)
+from . import schemas, crud, auth, migrations, persistence, search, ratelimit, transfer
+from .metrics import HTTP_REQUEST_SECONDS, registry
 from .ws.router import ws_router
+from .ws.connection_manager import manager
+from .ws.presence import presence
+from .recent_messages import recent_messages
+from .response_cache import response_cache
 
 from starlette.middleware.cors import CORSMiddleware 
 
 
-app = FastAPI()
+def prepare_database():
+    if DB_AUTO_MIGRATE:
+        for step in create_db_and_tables():
+            logger.info("Applied migration %d: %s", step.version, step.name)
+    else:
+        migrations.check(engine)
+    warm_pool(engine)
+    if replica_engine is not engine:
+        warm_pool(replica_engine)
+    db = ReadSessionLocal()
+    try:
+        crud.warm_queries(db)
+    finally:
+        db.close()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start = time.perf_counter()
+    await run_in_threadpool(prepare_database)
+    await manager.start()
+    await presence.start()
+    if persistence.writer is not None:
+        await persistence.writer.start()
+    # Last, so the imports do not hold the GIL while startup runs.
+    auth.preload()
+    logger.info("Startup complete in %.0f ms", (time.perf_counter() - start) * 1000)
+    yield
+    # The writer flushes buffered messages first, while the database and
+    # broker are still there.
+    if persistence.writer is not None:
+        await persistence.writer.stop()
+    await presence.stop()
+    await manager.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 origins = [
     "http://localhost:3000",
     "http://127.0.0.1:3000",
@@ -32,16 +88,57 @@ app.add_middleware(
 
 app.include_router(ws_router)
 
-@app.on_event("startup")
-def on_startup():
-    print("Creating database tables if they don't exist...")
-    create_db_and_tables()
-    print("Database tables created/checked.")
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        request.method,
+        route.path if route is not None else "unmatched",
+        str(response.status_code),
+    )
+    return response
+
+MAX_PAGE_SIZE = 1000
+# How long /admin/changes waits for a missing message id to commit before
+# it pages past the gap.
+CHANGES_SETTLE_MS = int(os.getenv("CHANGES_SETTLE_MS", "5000"))
+
+def stream_messages_ndjson(iter_messages, *args, **kwargs):
+    # The request-scoped session from get_db may already be closed while the
+    # body is still streaming, so the stream owns its own session.
+    def generate():
+        db = ReadSessionLocal()
+        try:
+            for message in iter_messages(db, *args, **kwargs):
+                yield schemas.MessageResponse.model_validate(message).model_dump_json() + "\n"
+        finally:
+            db.close()
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+def json_array(payloads: List[str]) -> str:
+    # Payloads are already serialized MessageResponse objects.
+    return "[" + ",".join(payloads) + "]"
+
+ROOM_SUMMARIES = TypeAdapter(List[schemas.AdminRoomSummary])
+
+async def cached_json_response(request: Request, key, room_id: Optional[str], load) -> Response:
+    # load() builds the JSON body. With the response cache on, it only runs
+    # when the body for the room's current version is not cached yet, and not
+    # at all for a matching If-None-Match (see app/response_cache.py).
+    if response_cache is None:
+        return Response(content=await load(), media_type="application/json")
+    return await response_cache.serve(request, key, room_id, load)
 
 @app.post("/auth/chat", response_model=schemas.UserLoginResponse)
-async def auth_and_enter_chat(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def auth_and_enter_chat(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # Checked before any bcrypt work or room creation.
+    await ratelimit.login_by_ip.enforce(ratelimit.client_ip(request))
+    await ratelimit.login_by_username.enforce(form_data.username)
     if form_data.username == auth.ADMIN_USERNAME:
-        if auth.verify_admin_password(form_data.password):
+        if await auth.verify_admin_password_async(form_data.password):
             access_token = auth.create_access_token(
                 data={"sub": form_data.username, "role": "admin", "room_id": None}
             )
@@ -55,10 +152,10 @@ async def auth_and_enter_chat(form_data: OAuth2PasswordRequestForm = Depends(),
         else:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin credentials")
 
-    user_room = crud.get_room_by_username(db, form_data.username)
+    user_room = await run_db(crud.get_room_by_username, db, form_data.username)
 
     if user_room:
-        if auth.verify_password(form_data.password, user_room.password):
+        if await auth.verify_password_async(form_data.password, user_room.password):
             access_token = auth.create_access_token(
                 data={"sub": user_room.username, "role": "user", "room_id": user_room.id}
             )
@@ -73,7 +170,7 @@ async def auth_and_enter_chat(form_data: OAuth2PasswordRequestForm = Depends(),
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect password for user, input corect password or create new username and password")
     else:
         new_room_data = schemas.RoomCreate(username=form_data.username, password=form_data.password)
-        new_room = crud.create_room(db, new_room_data)
+        new_room = await run_db(crud.create_room, db, new_room_data)
         
         access_token = auth.create_access_token(
             data={"sub": new_room.username, "role": "user", "room_id": new_room.id}
@@ -98,19 +195,52 @@ async def get_my_info(current_user_data: dict = Depends(auth.get_current_user)):
 
 @app.get("/chat/room/{room_id}/messages", response_model=List[schemas.MessageResponse])
 async def get_messages_in_room(
+    request: Request,
     room_id: str,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    since_seq: Optional[int] = Query(None, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
     db: Session = Depends(get_db),
+    read_db: Session = Depends(get_read_db),
     current_user_data: dict = Depends(auth.get_current_user)
 ):
     if current_user_data["role"] == "user" and room_id != current_user_data["room_id"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to view this room's messages.")
 
-    room = crud.get_room_by_id(db, room_id)
-    if not room:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
-    
-    messages = crud.get_messages_by_room_id(db, room_id)
-    return messages
+    if since_seq is not None and (before_id is not None or after_id is not None or stream):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="since_seq cannot be combined with before_id, after_id or stream.")
+
+    if stream:
+        room = await run_db(crud.get_room_by_id, db, room_id)
+        if not room:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+        return stream_messages_ndjson(crud.iter_messages_by_room_id, room_id, after_id=after_id)
+
+    async def load() -> str:
+        serve_recent = recent_messages is not None and before_id is None and after_id is None and since_seq is None
+        if serve_recent and recent_messages.is_loaded(room_id):
+            payloads = recent_messages.get(room_id, limit)
+            if payloads is not None:
+                return json_array(payloads)
+
+        room = await run_db(crud.get_room_by_id, db, room_id)
+        if not room:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
+
+        if serve_recent:
+            payloads = await recent_messages.get_or_load(db, room_id, limit)
+            if payloads is not None:
+                return json_array(payloads)
+
+        if since_seq is not None:
+            messages = await run_db(crud.get_messages_since_seq, read_db, room_id, since_seq, limit=limit)
+        else:
+            messages = await run_db(crud.get_messages_by_room_id, read_db, room_id, before_id=before_id, after_id=after_id, limit=limit)
+        return json_array([schemas.MessageResponse.model_validate(message).model_dump_json() for message in messages])
+
+    return await cached_json_response(request, ("history", room_id, before_id, after_id, since_seq, limit), room_id, load)
 
 @app.post("/chat/message", response_model=schemas.MessageResponse)
 async def send_message(
@@ -124,16 +254,20 @@ async def send_message(
     if current_user_data["role"] == "user" and message_data.room_id != current_user_data["room_id"]:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to send messages to this room.")
 
-    room = crud.get_room_by_id(db, message_data.room_id)
+    await ratelimit.messages_by_room.enforce(message_data.room_id)
+
+    room = await run_db(crud.get_room_by_id, db, message_data.room_id)
     if not room:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
 
-    new_message = crud.create_message(db, message_data)
+    new_message = await persistence.save_message(db, message_data)
     return new_message
 
 @app.post("/admin/token", response_model=schemas.Token)
-async def admin_login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    if form_data.username == auth.ADMIN_USERNAME and auth.verify_admin_password(form_data.password):
+async def admin_login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    await ratelimit.login_by_ip.enforce(ratelimit.client_ip(request))
+    await ratelimit.login_by_username.enforce(form_data.username)
+    if form_data.username == auth.ADMIN_USERNAME and await auth.verify_admin_password_async(form_data.password):
         access_token = auth.create_access_token(
             data={"sub": form_data.username, "role": "admin", "room_id": None}
         )
@@ -146,19 +280,148 @@ async def admin_login_for_access_token(form_data: OAuth2PasswordRequestForm = De
 
 @app.get("/admin/all_chats", response_model=List[schemas.MessageResponse])
 async def get_all_chats_for_admin(
-    db: Session = Depends(get_db),
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = False,
+    db: Session = Depends(get_read_db),
     current_admin_user: str = Depends(auth.get_current_admin_user)
 ):
-    messages = crud.get_all_messages(db)
+    if stream:
+        return stream_messages_ndjson(crud.iter_all_messages, after_id=after_id)
+
+    messages = await run_db(crud.get_all_messages, db, before_id=before_id, after_id=after_id, limit=limit)
     return messages
 
+@app.get("/admin/changes", response_model=schemas.MessageChanges)
+async def get_message_changes_for_admin(
+    since_id: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_read_db),
+    current_admin_user: str = Depends(auth.get_current_admin_user)
+):
+    # Poll with the returned next_since_id to receive only new messages.
+    # A message is delivered once, in id order, as long as its transaction
+    # commits within CHANGES_SETTLE_MS of a later message being written;
+    # one that takes longer may be skipped.
+    settled_before = datetime.now() - timedelta(milliseconds=CHANGES_SETTLE_MS)
+    messages, has_more = await run_db(crud.get_message_changes, db, since_id, limit, settled_before)
+    return schemas.MessageChanges(
+        messages=messages,
+        next_since_id=messages[-1].id if messages else since_id,
+        has_more=has_more,
+    )
+
 @app.get("/admin/rooms", response_model=List[schemas.AdminRoomSummary])
 async def get_all_rooms_summary_for_admin(
-    db: Session = Depends(get_db),
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    db: Session = Depends(get_read_db),
     current_admin_user: str = Depends(auth.get_current_admin_user)
 ):
-    rooms_summary = crud.get_all_rooms_summary(db)
-    return rooms_summary
+    async def load() -> bytes:
+        rooms_summary = await run_db(crud.get_all_rooms_summary, db, skip=skip, limit=limit)
+        return ROOM_SUMMARIES.dump_json(rooms_summary)
+
+    return await cached_json_response(request, ("rooms", skip, limit), None, load)
+
+@app.get("/admin/search", response_model=List[schemas.MessageSearchResult])
+async def search_messages_for_admin(
+    q: str = Query(..., min_length=1, max_length=200),
+    room_id: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_read_db),
+    current_admin_user: str = Depends(auth.get_current_admin_user)
+):
+    try:
+        results = await run_db(search.search_messages, db, q, room_id=room_id, limit=limit, offset=offset)
+    except NotImplementedError as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    return results
+
+TRANSFER_FORMAT = "^(" + "|".join(transfer.FORMATS) + ")$"
+TRANSFER_TABLE = "^(" + "|".join(transfer.TABLES) + ")$"
+
+@app.get("/admin/export")
+async def export_data_for_admin(
+    format: str = Query(transfer.NDJSON, pattern=TRANSFER_FORMAT),
+    table: Optional[str] = Query(None, pattern=TRANSFER_TABLE),
+    current_admin_user: str = Depends(auth.get_current_admin_user)
+):
+    if format == transfer.CSV and table is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="CSV exports need a table.")
+
+    def generate():
+        db = ReadSessionLocal()
+        try:
+            if format == transfer.CSV:
+                yield from transfer.export_csv(db, table)
+            else:
+                yield from transfer.export_ndjson(db, [table] if table else transfer.TABLES)
+        finally:
+            db.close()
+
+    media_type = "text/csv" if format == transfer.CSV else "application/x-ndjson"
+    filename = f"chat-{table or 'export'}.{format}"
+    return StreamingResponse(generate(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/admin/import")
+async def import_data_for_admin(
+    request: Request,
+    format: str = Query(transfer.NDJSON, pattern=TRANSFER_FORMAT),
+    table: Optional[str] = Query(None, pattern=TRANSFER_TABLE),
+    current_admin_user: str = Depends(auth.get_current_admin_user)
+):
+    # The body is spooled to a temporary file, then imported in batches from
+    # the threadpool. Batches written before an error stay committed.
+    if format == transfer.CSV and table is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="CSV imports need a table.")
+    if persistence.writer is not None:
+        # The writer hands out ids and seqs from its own counters, which
+        # imported rows would collide with.
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Imports are disabled with WRITE_BEHIND on; stop the app and use transfer_data.py.")
+    with tempfile.TemporaryFile() as spool:
+        async for chunk in request.stream():
+            spool.write(chunk)
+        spool.seek(0)
+        lines = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+        try:
+            counts = await run_in_threadpool(transfer.import_file, lines, format, table)
+        except IntegrityError as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Import conflicts with existing data: {e.orig}")
+        except (ValueError, KeyError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid import data: {e}")
+        finally:
+            # Imported rows bypass the recent message buffers. Reads during
+            # the import may also have cached pages built from them, so the
+            # response cache is reset once more at the end.
+            if recent_messages is not None:
+                recent_messages.clear()
+            if response_cache is not None:
+                response_cache.reset()
+    return counts
+
+@app.get("/admin/connections")
+async def get_websocket_connections_for_admin(
+    room_id: Optional[str] = None,
+    current_admin_user: str = Depends(auth.get_current_admin_user)
+):
+    return manager.connection_stats(room_id)
+
+@app.get("/admin/presence")
+async def get_presence_for_admin(
+    room_id: Optional[str] = None,
+    current_admin_user: str = Depends(auth.get_current_admin_user)
+):
+    return presence.snapshot(room_id)
+
+@app.get("/admin/auth_cache")
+async def get_auth_cache_stats_for_admin(current_admin_user: str = Depends(auth.get_current_admin_user)):
+    return auth.get_cache_stats()
 
 
 @app.post("/admin/reply_message", response_model=schemas.MessageResponse)
@@ -167,7 +430,7 @@ async def admin_reply_to_user(
     db: Session = Depends(get_db),
     current_admin_user: str = Depends(auth.get_current_admin_user)
 ):
-    room = crud.get_room_by_id(db, admin_message_data.room_id)
+    room = await run_db(crud.get_room_by_id, db, admin_message_data.room_id)
     if not room:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Room not found")
 
@@ -176,9 +439,15 @@ async def admin_reply_to_user(
         sender="admin",
         content=admin_message_data.content
     )
-    new_message = crud.create_message(db, message_to_create)
+    new_message = await persistence.save_message(db, message_to_create)
     return new_message
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/")
 async def root():
     return JSONResponse(content={"message": "Welcome to the Chat API!"})
\ No newline at end of file
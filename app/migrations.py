@@ -0,0 +1,227 @@
+import logging
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text,
+                        inspect, select, text)
+
+# Versioned schema migrations, applied in order by `python migrate.py` or,
+# with DB_AUTO_MIGRATE, at startup. Each one runs in its own transaction
+# together with the schema_migrations row that records it, so a failed step
+# leaves nothing half-applied. On an up-to-date database startup costs one
+# query instead of create_all reflecting every table.
+#
+# Databases created by create_all before migrations existed are adopted:
+# every step checks for what it creates, so on such a database the steps
+# that are already in place only record themselves.
+#
+# Steps are frozen once released: they describe the schema at the time they
+# were written, not the current models. Schema changes get a new step.
+
+logger = logging.getLogger(__name__)
+
+# Held by each migration transaction on PostgreSQL, so workers booting
+# together with DB_AUTO_MIGRATE apply every step exactly once.
+ADVISORY_LOCK_ID = 7245001
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str):
+    def register(apply: Callable) -> Callable:
+        MIGRATIONS.append(Migration(version, name, apply))
+        return apply
+    return register
+
+
+# The tables as first released, before any of the steps below.
+_initial = MetaData()
+Table(
+    "rooms", _initial,
+    Column("id", String, primary_key=True, index=True),
+    Column("username", String, unique=True, index=True, nullable=False),
+    Column("password", String, nullable=False),
+)
+Table(
+    "messages", _initial,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("room_id", String, ForeignKey("rooms.id"), nullable=False),
+    Column("sender", String, nullable=False),
+    Column("content", Text, nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+)
+
+_archive = MetaData()
+Table("rooms", _archive, Column("id", String, primary_key=True))
+Table(
+    "messages_archive", _archive,
+    Column("id", Integer, primary_key=True),
+    Column("room_id", String, ForeignKey("rooms.id"), nullable=False),
+    Column("sender", String, nullable=False),
+    Column("content", Text, nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+    Column("seq", Integer, nullable=False),
+    Index("ix_messages_archive_room_id_timestamp_id", "room_id", "timestamp", "id"),
+    Index("ix_messages_archive_room_id_seq", "room_id", "seq"),
+)
+
+
+@migration(1, "initial schema")
+def _create_initial_tables(connection):
+    _initial.create_all(connection)
+
+
+@migration(2, "message history index")
+def _add_message_history_index(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_room_id_timestamp_id ON messages (room_id, timestamp, id)"
+    ))
+
+
+@migration(3, "per-room message sequence numbers")
+def _add_message_seq(connection):
+    if "seq" in {column["name"] for column in inspect(connection).get_columns("messages")}:
+        return
+    connection.execute(text("ALTER TABLE rooms ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0"))
+    connection.execute(text("ALTER TABLE messages ADD COLUMN seq INTEGER"))
+    connection.execute(text("""
+        UPDATE messages SET seq = ranked.seq
+        FROM (SELECT id, row_number() OVER (PARTITION BY room_id ORDER BY timestamp, id) AS seq
+              FROM messages) AS ranked
+        WHERE messages.id = ranked.id
+    """))
+    connection.execute(text(
+        "UPDATE rooms SET last_seq = COALESCE((SELECT MAX(seq) FROM messages WHERE messages.room_id = rooms.id), 0)"
+    ))
+    if connection.dialect.name == "postgresql":
+        # SQLite cannot add the constraint to an existing column.
+        connection.execute(text("ALTER TABLE messages ALTER COLUMN seq SET NOT NULL"))
+    connection.execute(text("CREATE UNIQUE INDEX ix_messages_room_id_seq ON messages (room_id, seq)"))
+
+
+@migration(4, "message archive")
+def _create_message_archive(connection):
+    _archive.tables["messages_archive"].create(connection, checkfirst=True)
+
+
+@migration(5, "full-text search index")
+def _create_search_index(connection):
+    from . import search
+
+    search.create_search_index(connection)
+
+
+@migration(6, "room last message columns")
+def _add_room_last_message(connection):
+    if "last_message_id" in {column["name"] for column in inspect(connection).get_columns("rooms")}:
+        return
+    timestamp = "TIMESTAMP" if connection.dialect.name == "postgresql" else "DATETIME"
+    connection.execute(text("ALTER TABLE rooms ADD COLUMN last_message_id INTEGER"))
+    connection.execute(text(f"ALTER TABLE rooms ADD COLUMN last_message_at {timestamp}"))
+    connection.execute(text("ALTER TABLE rooms ADD COLUMN last_message_preview TEXT"))
+    connection.execute(text("""
+        UPDATE rooms
+        SET last_message_id = latest.id, last_message_at = latest.timestamp, last_message_preview = latest.content
+        FROM (SELECT room_id, id, timestamp, content,
+                     row_number() OVER (PARTITION BY room_id ORDER BY timestamp DESC, id DESC) AS rank
+              FROM (SELECT room_id, id, timestamp, content FROM messages
+                    UNION ALL
+                    SELECT room_id, id, timestamp, content FROM messages_archive) AS candidates) AS latest
+        WHERE latest.room_id = rooms.id AND latest.rank = 1
+    """))
+    # SQLite already sorts NULLs last when descending, but has no syntax to
+    # say so in an index.
+    nulls_last = " NULLS LAST" if connection.dialect.name == "postgresql" else ""
+    connection.execute(text(
+        f"CREATE INDEX ix_rooms_last_message_at ON rooms (last_message_at DESC{nulls_last}, username)"
+    ))
+
+
+@migration(7, "message timestamp index")
+def _add_message_timestamp_index(connection):
+    # Keyset pages across all rooms.
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_timestamp_id ON messages (timestamp, id)"))
+
+
+@migration(8, "archive timestamp index")
+def _add_archive_timestamp_index(connection):
+    # The archive's half of keyset pages across all rooms.
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_archive_timestamp_id ON messages_archive (timestamp, id)"
+    ))
+
+
+@migration(9, "archive full-text search index")
+def _create_archive_search_index(connection):
+    from . import search
+
+    search.create_archive_search_index(connection)
+
+
+def _lock(connection):
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+
+
+def _applied(connection) -> dict:
+    rows = connection.execute(select(schema_migrations.c.version, schema_migrations.c.applied_at))
+    return {version: applied_at for version, applied_at in rows}
+
+
+def status(engine) -> List[tuple]:
+    """(version, name, applied_at or None) for every known migration."""
+    with engine.connect() as connection:
+        applied = _applied(connection) if inspect(connection).has_table(schema_migrations.name) else {}
+    return [(step.version, step.name, applied.get(step.version)) for step in MIGRATIONS]
+
+
+def pending(engine) -> List[Migration]:
+    applied = {version for version, _, applied_at in status(engine) if applied_at is not None}
+    return [step for step in MIGRATIONS if step.version not in applied]
+
+
+def upgrade(engine, target: Optional[int] = None) -> List[Migration]:
+    """Applies pending migrations up to target (default: all); returns them."""
+    with engine.begin() as connection:
+        _lock(connection)
+        schema_migrations.create(connection, checkfirst=True)
+        applied = _applied(connection)
+    done = []
+    for step in MIGRATIONS:
+        if step.version in applied or (target is not None and step.version > target):
+            continue
+        with engine.begin() as connection:
+            _lock(connection)
+            # Another worker may have applied it while this one waited.
+            if step.version in _applied(connection):
+                continue
+            logger.info("Applying migration %d: %s", step.version, step.name)
+            step.apply(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=step.version, name=step.name, applied_at=datetime.now()
+            ))
+        done.append(step)
+    return done
+
+
+def check(engine):
+    """Raises RuntimeError if the database is behind this code's migrations."""
+    missing = pending(engine)
+    if missing:
+        versions = ", ".join(str(step.version) for step in missing)
+        raise RuntimeError(f"Database schema is out of date (pending migrations: {versions}). "
+                           f"Run `python migrate.py` first.")
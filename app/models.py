@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -9,8 +9,19 @@ class Room(Base):
     id = Column(String, primary_key=True, index=True, default=lambda: str(uuid.uuid4()))
     username = Column(String, unique=True, index=True, nullable=False)
     password = Column(String, nullable=False)
+    # Highest Message.seq handed out in this room.
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
+    # The room's newest message, hot or archived, kept up to date by crud so
+    # the admin room list is a scan of ix_rooms_last_message_at.
+    last_message_id = Column(Integer)
+    last_message_at = Column(DateTime)
+    last_message_preview = Column(Text)
     messages = relationship("Message", back_populates="room", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_rooms_last_message_at", last_message_at.desc().nulls_last(), username),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
@@ -18,4 +29,29 @@ class Message(Base):
     sender = Column(String, nullable=False)
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.now, nullable=False)
-    room = relationship("Room", back_populates="messages")
\ No newline at end of file
+    # Per-room sequence number, 1, 2, 3, ... in the order messages were saved.
+    seq = Column(Integer, nullable=False)
+    room = relationship("Room", back_populates="messages")
+
+    __table_args__ = (
+        Index("ix_messages_room_id_timestamp_id", "room_id", "timestamp", "id"),
+        Index("ix_messages_timestamp_id", "timestamp", "id"),
+        Index("ix_messages_room_id_seq", "room_id", "seq", unique=True),
+    )
+
+class ArchivedMessage(Base):
+    # Messages moved out of the hot table by the retention job. Per room they
+    # are always older than everything still in messages.
+    __tablename__ = "messages_archive"
+    id = Column(Integer, primary_key=True)
+    room_id = Column(String, ForeignKey("rooms.id"), nullable=False)
+    sender = Column(String, nullable=False)
+    content = Column(Text, nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    seq = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_messages_archive_room_id_timestamp_id", "room_id", "timestamp", "id"),
+        Index("ix_messages_archive_room_id_seq", "room_id", "seq"),
+        Index("ix_messages_archive_timestamp_id", "timestamp", "id"),
+    )
\ No newline at end of file
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal, run_db
+from . import crud, schemas
+from .recent_messages import recent_messages
+from .response_cache import response_cache
+from .metrics import MESSAGES, counter, gauge
+from .ws.pubsub import BROADCAST_URL
+
+logger = logging.getLogger(__name__)
+
+# Write-behind mode: messages get an id up front, are broadcast at once and
+# are written in bulk every WRITE_BEHIND_FLUSH_MS or WRITE_BEHIND_BATCH_SIZE
+# messages, whichever comes first. Off by default.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "50"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+# Failed flushes are retried with the interval doubling up to
+# WRITE_BEHIND_RETRY_MAX_MS. After WRITE_BEHIND_MAX_RETRIES failures in a row
+# the rows of the failing flush are dropped, so a long outage cannot block
+# new messages for good.
+WRITE_BEHIND_MAX_RETRIES = int(os.getenv("WRITE_BEHIND_MAX_RETRIES", "10"))
+WRITE_BEHIND_RETRY_MAX_MS = int(os.getenv("WRITE_BEHIND_RETRY_MAX_MS", "5000"))
+
+# The writer numbers rows from counters held in this process, so a second
+# process writing the same database hands out the same ids and seqs. Its
+# rows then fail the unique constraints and are dropped after broadcast.
+# A cross-worker broker (BROADCAST_URL) or WEB_CONCURRENCY, which uvicorn
+# and gunicorn read as their worker count, means more than one process.
+if WRITE_BEHIND and (BROADCAST_URL or int(os.getenv("WEB_CONCURRENCY", "1")) > 1):
+    raise ValueError("WRITE_BEHIND needs a single app process; unset BROADCAST_URL and WEB_CONCURRENCY "
+                     "or turn WRITE_BEHIND off.")
+
+DROPPED_MESSAGES = counter("write_behind_dropped_messages_total",
+                           "Buffered messages dropped instead of being written.", ("reason",))
+
+
+class MessageWriter:
+    """Buffers new messages and persists them with bulk inserts.
+
+    Ids are reserved in blocks: from the serial sequence on PostgreSQL, and
+    from a process-local counter seeded with MAX(id) elsewhere. The local
+    counter is only safe with a single writer process, so on SQLite every
+    message in the process must go through the writer.
+
+    Per-room seqs come from counters seeded with rooms.last_seq the first
+    time a room is written to, so they too assume this process is the only
+    one writing to its rooms. The module refuses to start the writer when
+    the configuration points at several processes.
+
+    A batch that violates a constraint is split in halves until the rows
+    that cannot be inserted are isolated; those are logged and dropped, and
+    the rest is written. They were already broadcast, so they only go
+    missing from the stored history.
+    """
+
+    def __init__(self, flush_ms: int = WRITE_BEHIND_FLUSH_MS, batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 max_pending: int = WRITE_BEHIND_MAX_PENDING, max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+                 retry_max_ms: int = WRITE_BEHIND_RETRY_MAX_MS, session_factory=SessionLocal):
+        self.flush_interval = flush_ms / 1000
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_max_interval = retry_max_ms / 1000
+        self._failures = 0
+        self._session_factory = session_factory
+        self._pending: List[dict] = []
+        self._ids: deque = deque()
+        self._next_local_id: Optional[int] = None
+        self._room_seqs: dict[str, int] = {}
+        self._id_lock = asyncio.Lock()
+        self._seq_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Drain everything still buffered before the worker exits.
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def submit(self, message: schemas.MessageCreate) -> schemas.MessageResponse:
+        while len(self._pending) >= self.max_pending:
+            await self.flush()
+
+        row = {
+            "id": await self._next_id(),
+            "seq": await self._next_seq(message.room_id),
+            "room_id": message.room_id,
+            "sender": message.sender,
+            "content": message.content,
+            "timestamp": datetime.now(),
+        }
+        self._pending.append(row)
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+        return schemas.MessageResponse(**row)
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            # Chunks still to write, the next one last; see _write_isolating.
+            chunks = [batch]
+            rejected: List[tuple] = []
+            try:
+                await run_in_threadpool(self._write_isolating, chunks, rejected)
+            except Exception:
+                unwritten = [row for chunk in reversed(chunks) for row in chunk]
+                self._failures += 1
+                if self._failures > self.max_retries:
+                    self._failures = 0
+                    self._drop(unwritten, "error", f"{self.max_retries} retries failed")
+                else:
+                    # Keep the rows for the next attempt, ahead of newer ones.
+                    self._pending = unwritten + self._pending
+                raise
+            finally:
+                for row, error in rejected:
+                    self._drop([row], "rejected", error)
+            self._failures = 0
+
+    def _drop(self, rows: List[dict], reason: str, error):
+        DROPPED_MESSAGES.inc(reason, amount=len(rows))
+        for row in rows:
+            logger.error("Dropping buffered message id=%s room_id=%s seq=%s reason=%s error=%s",
+                         row["id"], row["room_id"], row["seq"], reason, error)
+
+    async def _run(self):
+        while True:
+            timeout = self.flush_interval
+            if self._failures:
+                # Backs off while flushes keep failing.
+                timeout = min(timeout * 2 ** self._failures, self.retry_max_interval)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error flushing buffered messages pending=%d", len(self._pending))
+
+    def _write(self, batch: List[dict]):
+        db = self._session_factory()
+        try:
+            crud.bulk_create_messages(db, batch)
+        finally:
+            db.close()
+
+    def _write_isolating(self, chunks: List[List[dict]], rejected: List[tuple]):
+        # Writes chunks from the end of the list, halving any chunk that
+        # violates a constraint until the offending rows stand alone; those
+        # go to rejected. Another error propagates with the chunks not yet
+        # written still in the list.
+        while chunks:
+            chunk = chunks[-1]
+            try:
+                self._write(chunk)
+            except IntegrityError as e:
+                chunks.pop()
+                if len(chunk) == 1:
+                    rejected.append((chunk[0], e.orig))
+                else:
+                    middle = len(chunk) // 2
+                    chunks.extend((chunk[middle:], chunk[:middle]))
+                continue
+            chunks.pop()
+
+    async def _next_id(self) -> int:
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    self._ids.extend(await run_in_threadpool(self._reserve_ids, self.batch_size))
+        return self._ids.popleft()
+
+    async def _next_seq(self, room_id: str) -> int:
+        if room_id not in self._room_seqs:
+            async with self._seq_lock:
+                if room_id not in self._room_seqs:
+                    self._room_seqs[room_id] = await run_in_threadpool(self._load_room_seq, room_id)
+        self._room_seqs[room_id] += 1
+        return self._room_seqs[room_id]
+
+    def _load_room_seq(self, room_id: str) -> int:
+        db: Session = self._session_factory()
+        try:
+            return crud.get_room_last_seq(db, room_id)
+        finally:
+            db.close()
+
+    def _reserve_ids(self, count: int) -> List[int]:
+        db: Session = self._session_factory()
+        try:
+            if db.get_bind().dialect.name == "postgresql":
+                return crud.reserve_message_ids(db, count)
+            if self._next_local_id is None:
+                self._next_local_id = crud.get_max_message_id(db) + 1
+        finally:
+            db.close()
+        ids = list(range(self._next_local_id, self._next_local_id + count))
+        self._next_local_id += count
+        return ids
+
+
+writer: Optional[MessageWriter] = MessageWriter() if WRITE_BEHIND else None
+
+if writer is not None:
+    gauge("write_behind_pending_messages", "Messages buffered by the write-behind writer.",
+          collect=lambda: [((), writer.pending)])
+
+
+async def save_message(db: Session, message: schemas.MessageCreate) -> schemas.MessageResponse:
+    saved_message, _ = await save_and_encode_message(db, message)
+    return saved_message
+
+
+async def save_and_encode_message(db: Session, message: schemas.MessageCreate) -> tuple[schemas.MessageResponse, str]:
+    # Serializes the saved message once; the JSON is shared by the recent
+    # message buffer and the broadcast.
+    if writer is not None:
+        saved_message = await writer.submit(message)
+    else:
+        db_message = await run_db(crud.create_message, db, message)
+        saved_message = schemas.MessageResponse.model_validate(db_message)
+    MESSAGES.inc()
+    payload = saved_message.model_dump_json()
+    if recent_messages is not None:
+        recent_messages.append(saved_message.room_id, saved_message.id, payload)
+    if response_cache is not None:
+        # Only after the append: history is served from recent_messages, so
+        # a request that read the new version before it would file the old
+        # body under it.
+        response_cache.bump(saved_message.room_id)
+    return saved_message, payload
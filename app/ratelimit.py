@@ -0,0 +1,194 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from fastapi import HTTPException, Request, status
+
+from .metrics import counter
+
+# Token buckets: each key holds up to `burst` tokens, refilled at `rate` per
+# second, and every request spends one. Limits are written "N/period", e.g.
+# "10/minute", meaning bursts of N refilled over one period. "0" or an empty
+# value turns a limit off.
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+# Shared store for several workers, e.g. redis://localhost:6379/1. Buckets
+# are kept in process memory when unset.
+RATE_LIMIT_STORE_URL = os.getenv("RATE_LIMIT_STORE_URL")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Only behind a proxy that sets X-Forwarded-For; clients can forge it otherwise.
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() in ("1", "true", "yes")
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+RATE_LIMITED = counter("rate_limited_total", "Requests and frames rejected by rate limits.", ("limit",))
+
+
+def parse_limit(value: str) -> Optional[tuple[float, float]]:
+    """Parses "N/period" into (tokens per second, burst); None when disabled."""
+    value = value.strip()
+    if value in ("", "0"):
+        return None
+    try:
+        count, period = value.split("/", 1)
+        burst = float(count)
+        seconds = PERIODS[period.strip().lower().rstrip("s")]
+    except (ValueError, KeyError):
+        raise ValueError(f"Invalid rate limit {value!r}; expected e.g. '10/minute'.")
+    if burst <= 0:
+        return None
+    return burst / seconds, burst
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+    def take(self, rate: float, burst: float, now: float, cost: float = 1.0) -> float:
+        """Spends cost tokens; returns 0 if allowed, else seconds until it would be."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / rate
+
+
+class MemoryStore:
+    """Buckets for this process, capped at max_keys.
+
+    The least recently used bucket is dropped when the cap is reached. A
+    dropped bucket comes back full, which only ever errs towards allowing.
+    Only touched from the event loop, so it takes no locks.
+    """
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(burst, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(rate, burst, now, cost)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisStore:
+    """Buckets shared by every worker, updated atomically in a Lua script."""
+
+    KEY_PREFIX = "ratelimit:"
+
+    # Uses the server clock so workers with skewed clocks agree. Returns the
+    # wait as a string, since Lua numbers are truncated to integers on return.
+    SCRIPT = """
+    local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local clock = redis.call('TIME')
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        wait = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("RATE_LIMIT_STORE_URL is set but the 'redis' package is not installed.") from e
+        self._redis = redis.from_url(url)
+        self._script = self._redis.register_script(self.SCRIPT)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        wait = await self._script(keys=[self.KEY_PREFIX + key], args=[rate, burst, cost])
+        return float(wait)
+
+
+def create_store():
+    if RATE_LIMIT_STORE_URL:
+        return RedisStore(RATE_LIMIT_STORE_URL)
+    return MemoryStore()
+
+
+store = create_store()
+
+
+class RateLimit:
+    def __init__(self, name: str, limit: str, store=None):
+        self.name = name
+        self.limit = parse_limit(limit) if RATE_LIMIT_ENABLED else None
+        self._store = store
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit is not None
+
+    async def hit(self, key: str) -> float:
+        """Counts one request for key; returns 0 if allowed, else the wait in seconds."""
+        if self.limit is None:
+            return 0.0
+        rate, burst = self.limit
+        wait = await (self._store or store).take(f"{self.name}:{key}", rate, burst)
+        if wait:
+            RATE_LIMITED.inc(self.name)
+        return wait
+
+    def bucket(self) -> Optional[TokenBucket]:
+        """A standalone bucket for state owned by the caller, e.g. one socket."""
+        if self.limit is None:
+            return None
+        return TokenBucket(self.limit[1], time.monotonic())
+
+    def take(self, bucket: Optional[TokenBucket]) -> float:
+        if bucket is None:
+            return 0.0
+        rate, burst = self.limit
+        wait = bucket.take(rate, burst, time.monotonic())
+        if wait:
+            RATE_LIMITED.inc(self.name)
+        return wait
+
+    async def enforce(self, key: str):
+        """Counts one request for key and raises 429 if it is over the limit."""
+        wait = await self.hit(key)
+        if wait:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests. Please try again later.",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",", 1)[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+login_by_ip = RateLimit("login_ip", os.getenv("RATE_LIMIT_LOGIN_IP", "20/minute"))
+login_by_username = RateLimit("login_username", os.getenv("RATE_LIMIT_LOGIN_USERNAME", "10/minute"))
+messages_by_room = RateLimit("messages_room", os.getenv("RATE_LIMIT_MESSAGES_ROOM", "60/minute"))
+ws_frames = RateLimit("ws_frames", os.getenv("RATE_LIMIT_WS_FRAMES", "10/second"))
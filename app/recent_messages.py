@@ -0,0 +1,161 @@
+import bisect
+import os
+from collections import OrderedDict, deque
+from typing import Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from .database import run_db
+from . import crud, schemas
+
+# Buffers live in one worker, so with a cross-worker broker (BROADCAST_URL)
+# they would miss messages saved elsewhere; they are off by default there.
+RECENT_MESSAGES_ENABLED = os.getenv(
+    "RECENT_MESSAGES_ENABLED", "false" if os.getenv("BROADCAST_URL") else "true"
+).lower() in ("1", "true", "yes")
+RECENT_MESSAGES_PER_ROOM = int(os.getenv("RECENT_MESSAGES_PER_ROOM", "50"))
+RECENT_MESSAGES_MAX_BYTES = int(os.getenv("RECENT_MESSAGES_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Rough per-entry cost of the slot object and deque cell on top of the payload.
+ENTRY_OVERHEAD_BYTES = 96
+
+
+class BufferedMessage:
+    __slots__ = ("id", "payload")
+
+    def __init__(self, id: int, payload: str):
+        self.id = id
+        self.payload = payload
+
+
+class RoomBuffer:
+    __slots__ = ("messages", "loaded", "complete", "size")
+
+    def __init__(self, capacity: int):
+        self.messages: deque = deque(maxlen=capacity)
+        # loaded: seeded from the database; complete: holds the whole history.
+        self.loaded = False
+        self.complete = False
+        self.size = 0
+
+
+class RecentMessages:
+    """Per-room ring buffers of serialized MessageResponse payloads.
+
+    Rooms are evicted least-recently-used first once the buffered payloads
+    exceed max_bytes. Only touched from the event loop, so it takes no locks.
+    """
+
+    def __init__(self, per_room: int = RECENT_MESSAGES_PER_ROOM, max_bytes: int = RECENT_MESSAGES_MAX_BYTES):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._rooms: "OrderedDict[str, RoomBuffer]" = OrderedDict()
+
+    def is_loaded(self, room_id: str) -> bool:
+        buffer = self._rooms.get(room_id)
+        return buffer is not None and buffer.loaded
+
+    def append(self, room_id: str, message_id: int, payload: str):
+        buffer = self._buffer(room_id)
+        messages = buffer.messages
+        if not messages or message_id > messages[-1].id:
+            self._push(buffer, BufferedMessage(message_id, payload))
+        else:
+            # Saves on different threads can finish out of id order, and a
+            # message may already be in the buffer from load().
+            self._insert(buffer, BufferedMessage(message_id, payload))
+        self._evict()
+
+    def load(self, room_id: str, messages: Iterable, complete: bool):
+        # Merge with anything appended before the room was first read, e.g.
+        # write-behind messages that are not in the database yet.
+        buffer = self._buffer(room_id)
+        entries = {entry.id: entry for entry in buffer.messages}
+        for message in messages:
+            if message.id not in entries:
+                payload = schemas.MessageResponse.model_validate(message).model_dump_json()
+                entries[message.id] = BufferedMessage(message.id, payload)
+
+        buffer.messages.clear()
+        self.total_bytes -= buffer.size
+        buffer.size = 0
+        ordered = sorted(entries.values(), key=lambda entry: entry.id)
+        for entry in ordered:
+            self._push(buffer, entry)
+        buffer.loaded = True
+        buffer.complete = complete and len(ordered) <= self.per_room
+        self._evict()
+
+    def get(self, room_id: str, limit: Optional[int] = None) -> Optional[List[str]]:
+        """Latest payloads oldest-first, or None if the buffer cannot answer."""
+        buffer = self._rooms.get(room_id)
+        if buffer is None or not buffer.loaded:
+            return None
+        if limit is None or limit > len(buffer.messages):
+            if not buffer.complete:
+                return None
+            limit = len(buffer.messages)
+        self._rooms.move_to_end(room_id)
+        entries = list(buffer.messages)
+        return [entry.payload for entry in entries[len(entries) - limit:]]
+
+    async def get_or_load(self, db: Session, room_id: str, limit: Optional[int] = None) -> Optional[List[str]]:
+        if not self.is_loaded(room_id):
+            # One extra row tells whether the room fits in the buffer entirely.
+            messages = await run_db(crud.get_latest_messages_by_room_id, db, room_id, self.per_room + 1)
+            self.load(room_id, messages[-self.per_room:], complete=len(messages) <= self.per_room)
+        return self.get(room_id, limit)
+
+    def clear(self):
+        """Drops every buffer, e.g. after rows were written in bulk."""
+        self._rooms.clear()
+        self.total_bytes = 0
+
+    def _buffer(self, room_id: str) -> RoomBuffer:
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            buffer = RoomBuffer(self.per_room)
+            self._rooms[room_id] = buffer
+        self._rooms.move_to_end(room_id)
+        return buffer
+
+    def _push(self, buffer: RoomBuffer, entry: BufferedMessage):
+        if len(buffer.messages) == buffer.messages.maxlen:
+            self._drop_oldest(buffer)
+        buffer.messages.append(entry)
+        self._add_size(buffer, entry)
+
+    def _insert(self, buffer: RoomBuffer, entry: BufferedMessage):
+        messages = buffer.messages
+        ids = [message.id for message in messages]
+        position = bisect.bisect_left(ids, entry.id)
+        if position < len(ids) and ids[position] == entry.id:
+            return
+        if len(messages) == messages.maxlen:
+            if position == 0:
+                # Older than everything kept; the database still has it.
+                buffer.complete = False
+                return
+            self._drop_oldest(buffer)
+            position -= 1
+        messages.insert(position, entry)
+        self._add_size(buffer, entry)
+
+    def _drop_oldest(self, buffer: RoomBuffer):
+        dropped = buffer.messages.popleft()
+        buffer.size -= len(dropped.payload) + ENTRY_OVERHEAD_BYTES
+        self.total_bytes -= len(dropped.payload) + ENTRY_OVERHEAD_BYTES
+        buffer.complete = False
+
+    def _add_size(self, buffer: RoomBuffer, entry: BufferedMessage):
+        buffer.size += len(entry.payload) + ENTRY_OVERHEAD_BYTES
+        self.total_bytes += len(entry.payload) + ENTRY_OVERHEAD_BYTES
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._rooms) > 1:
+            _, buffer = self._rooms.popitem(last=False)
+            self.total_bytes -= buffer.size
+
+
+recent_messages: Optional[RecentMessages] = RecentMessages() if RECENT_MESSAGES_ENABLED else None
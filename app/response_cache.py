@@ -0,0 +1,227 @@
+import gzip
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple, Union
+
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+
+from .metrics import counter, gauge
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Cached JSON bodies for the polled read endpoints, checked against version
+# counters: one per room, bumped by every write to its messages, and a
+# global one behind /admin/rooms that any room write or new room bumps. A
+# request whose If-None-Match matches the current version gets a 304 with no
+# database query; a cached body is served for as long as its version is
+# current.
+#
+# Versions live in one worker, like the recent message buffers. With a
+# cross-worker broker (BROADCAST_URL) another worker's writes would go
+# unnoticed, and with a read replica a page could be cached before the
+# replica caught up, so the cache is off by default in both setups. Moving
+# messages to the archive changes no response, so archive_messages.py running
+# in a process of its own needs no invalidation.
+RESPONSE_CACHE_ENABLED = os.getenv(
+    "RESPONSE_CACHE_ENABLED",
+    "false" if os.getenv("BROADCAST_URL") or os.getenv("DATABASE_REPLICA_URL") else "true",
+).lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Bodies at least this large are also kept compressed, gzip or brotli (when
+# installed), for clients that accept it. 0 turns compression off.
+RESPONSE_CACHE_COMPRESS_MIN_BYTES = int(os.getenv("RESPONSE_CACHE_COMPRESS_MIN_BYTES", "1024"))
+
+RESPONSE_CACHE_REQUESTS = counter("response_cache_requests_total",
+                                  "Requests to cached endpoints by outcome.", ("result",))
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _accepted_encodings(header: str) -> Set[str]:
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match calls for.
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any(tag.strip().removeprefix("W/") == opaque for tag in header.split(","))
+
+
+class CachedResponse:
+    __slots__ = ("etag", "modified", "body", "encoded", "size")
+
+    def __init__(self, etag: str, modified: float, body: bytes):
+        self.etag = etag
+        self.modified = modified
+        self.body = body
+        self.encoded: Dict[str, bytes] = {}
+        self.size = len(body)
+
+
+class ResponseCache:
+    """Version counters plus an LRU of encoded bodies, capped at max_bytes.
+
+    Versions are bumped from crud in threadpool workers and take a lock;
+    the bodies are only touched from the event loop and take none. ETags
+    carry a per-process epoch, so one issued by another worker or before a
+    restart never matches.
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+                 compress_min_bytes: int = RESPONSE_CACHE_COMPRESS_MIN_BYTES):
+        self.max_bytes = max_bytes
+        self.compress_min_bytes = compress_min_bytes
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._reset_versions()
+
+    def _reset_versions(self):
+        self._epoch = uuid.uuid4().hex[:12]
+        # Nothing older than this is known about, so it is every room's
+        # modification time until the room's first write.
+        self._started = time.time()
+        self._versions: Dict[str, Tuple[int, float]] = {}
+        self._global = (0, self._started)
+
+    def bump(self, *room_ids: str):
+        """Marks the rooms, and so the room summaries, as changed. Call after commit."""
+        now = time.time()
+        with self._lock:
+            for room_id in room_ids:
+                self._versions[room_id] = (self._versions.get(room_id, (0, 0.0))[0] + 1, now)
+            self._global = (self._global[0] + 1, now)
+
+    def bump_global(self):
+        self.bump()
+
+    def reset(self):
+        """Invalidates everything, e.g. after rows were written in bulk."""
+        with self._lock:
+            self._reset_versions()
+
+    def version(self, room_id: Optional[str] = None) -> Tuple[str, float]:
+        """(version tag, last modified) of a room, or of the global counter."""
+        with self._lock:
+            if room_id is None:
+                version, modified = self._global
+            else:
+                version, modified = self._versions.get(room_id, (0, self._started))
+            return f"{self._epoch}.{version}", modified
+
+    async def serve(self, request: Request, key: Hashable, room_id: Optional[str],
+                    load: Callable[[], Awaitable[Union[str, bytes]]]) -> Response:
+        # The version is read before loading, so a write that lands during
+        # the load leaves the body filed under the older version. The key is
+        # part of the ETag so it only ever validates the URL it came from.
+        version, modified = self.version(room_id)
+        etag = f'W/"{version}.{hash(key) & 0xffffffff:x}"'
+        if self._not_modified(request, etag, modified):
+            RESPONSE_CACHE_REQUESTS.inc("not_modified")
+            return Response(status_code=304, headers=self._headers(etag, modified))
+
+        entry = self._entries.get(key)
+        if entry is not None and entry.etag == etag:
+            self._entries.move_to_end(key)
+            RESPONSE_CACHE_REQUESTS.inc("hit")
+        else:
+            RESPONSE_CACHE_REQUESTS.inc("miss")
+            body = await load()
+            entry = self._put(key, CachedResponse(etag, modified, body.encode() if isinstance(body, str) else body))
+
+        headers = self._headers(entry.etag, entry.modified)
+        encoding = self._encoding(request, entry)
+        if encoding is None:
+            return Response(content=entry.body, media_type="application/json", headers=headers)
+        body = entry.encoded.get(encoding)
+        if body is None:
+            body = await run_in_threadpool(self._compress, encoding, entry.body)
+            if self._entries.get(key) is entry and encoding not in entry.encoded:
+                entry.encoded[encoding] = body
+                entry.size += len(body)
+                self.total_bytes += len(body)
+                self._evict()
+        headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def _not_modified(self, request: Request, etag: str, modified: float) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            return _etag_matches(if_none_match, etag)
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since is None or not self._last_modified_final(modified):
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(modified) <= since
+
+    @staticmethod
+    def _last_modified_final(modified: float) -> bool:
+        # Last-Modified has one-second resolution. It is only sent once its
+        # second is over, so a later write always moves it forward.
+        return int(modified) < int(time.time())
+
+    def _headers(self, etag: str, modified: float) -> dict:
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Accept-Encoding"}
+        if self._last_modified_final(modified):
+            headers["Last-Modified"] = formatdate(int(modified), usegmt=True)
+        return headers
+
+    def _encoding(self, request: Request, entry: CachedResponse) -> Optional[str]:
+        if not self.compress_min_bytes or len(entry.body) < self.compress_min_bytes:
+            return None
+        accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    @staticmethod
+    def _compress(encoding: str, body: bytes) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=BROTLI_QUALITY)
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+    def _put(self, key: Hashable, entry: CachedResponse) -> CachedResponse:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.total_bytes -= old.size
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        self._evict()
+        return entry
+
+    def _evict(self):
+        # The newest entry stays even when it alone is over the budget.
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry.size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+response_cache: Optional[ResponseCache] = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+
+if response_cache is not None:
+    gauge("response_cache_bytes", "Bytes of cached response bodies on this worker.",
+          collect=lambda: [((), response_cache.total_bytes)])
@@ -0,0 +1,54 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from .database import SessionLocal
+from . import crud
+
+logger = logging.getLogger(__name__)
+
+# Messages older than RETENTION_MAX_AGE_DAYS, or beyond the newest
+# RETENTION_MAX_PER_ROOM in their room, are moved to messages_archive.
+# 0 turns a rule off. History endpoints read archived messages through
+# transparently, so this only shrinks the hot table.
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_PER_ROOM = int(os.getenv("RETENTION_MAX_PER_ROOM", "0"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+# Pause between batches so writers are not starved of the table.
+RETENTION_BATCH_PAUSE_MS = int(os.getenv("RETENTION_BATCH_PAUSE_MS", "50"))
+
+
+def archive_messages(max_age_days: int = RETENTION_MAX_AGE_DAYS, max_per_room: int = RETENTION_MAX_PER_ROOM,
+                     batch_size: int = RETENTION_BATCH_SIZE, pause_ms: int = RETENTION_BATCH_PAUSE_MS,
+                     session_factory=SessionLocal) -> int:
+    """Archives room by room in batches of batch_size, each in its own
+    short transaction. Returns the number of messages moved."""
+    cutoff: Optional[datetime] = datetime.now() - timedelta(days=max_age_days) if max_age_days else None
+    db = session_factory()
+    try:
+        rooms = crud.get_room_seqs(db)
+    finally:
+        db.close()
+
+    total = 0
+    for room_id, last_seq in rooms:
+        max_seq = last_seq - max_per_room if max_per_room else None
+        if cutoff is None and (max_seq is None or max_seq < 1):
+            continue
+        while True:
+            db = session_factory()
+            try:
+                moved = crud.archive_room_messages(db, room_id, cutoff=cutoff, max_seq=max_seq, batch_size=batch_size)
+            finally:
+                db.close()
+            total += moved
+            if moved < batch_size:
+                break
+            time.sleep(pause_ms / 1000)
+        if total:
+            logger.debug("Archived messages room_id=%s total=%d", room_id, total)
+
+    logger.info("Archived %d messages from %d rooms", total, len(rooms))
+    return total
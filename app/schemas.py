@@ -24,11 +24,21 @@ class MessageCreate(MessageBase):
 class MessageResponse(MessageBase):
     id: int
     room_id: str
+    seq: int
     timestamp: datetime
 
     class Config:
         from_attributes = True
 
+class MessageSearchResult(MessageResponse):
+    rank: float
+    snippet: str
+
+class MessageChanges(BaseModel):
+    messages: List[MessageResponse]
+    next_since_id: int
+    has_more: bool
+
 class AdminMessageCreate(BaseModel):
     room_id: str 
     content: str
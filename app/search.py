@@ -0,0 +1,167 @@
+import html
+import os
+import re
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from . import schemas
+
+# Full-text index over the content of messages and messages_archive.
+# PostgreSQL gets a generated tsvector column with a GIN index, SQLite an
+# external-content FTS5 table kept in sync by triggers. Both are maintained
+# by the database on every insert, so messages written by
+# crud.create_message or in bulk by the write-behind writer are searchable as
+# soon as they are committed, and stay searchable once they are archived.
+
+# Text search configuration for PostgreSQL. "simple" does no stemming, which
+# suits chats that mix languages.
+SEARCH_LANGUAGE = os.getenv("SEARCH_LANGUAGE", "simple")
+if not re.fullmatch(r"[a-z_]+", SEARCH_LANGUAGE):
+    raise ValueError("SEARCH_LANGUAGE must be the name of a PostgreSQL text search configuration.")
+
+# Snippets are HTML: the message text is escaped and each match wrapped in
+# <mark>. The database marks matches with private-use characters instead, so
+# the markers can be added after escaping what users wrote.
+SNIPPET_START = "<mark>"
+SNIPPET_STOP = "</mark>"
+MATCH_START = "\ue000"
+MATCH_STOP = "\ue001"
+
+SEARCH_TABLES = ("messages", "messages_archive")
+
+
+def _postgres_ddl(table: str) -> List[str]:
+    return [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_LANGUAGE}', content)) STORED",
+        f"CREATE INDEX IF NOT EXISTS ix_{table}_content_tsv ON {table} USING GIN (content_tsv)",
+    ]
+
+
+def _sqlite_ddl(table: str) -> List[str]:
+    fts = f"{table}_fts"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"content, content='{table}', content_rowid='id', tokenize='unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF content ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); "
+        f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END",
+    ]
+
+
+def _create_index(connection, table: str):
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        # Adding the generated column computes it for every existing row.
+        for statement in _postgres_ddl(table):
+            connection.execute(text(statement))
+    elif dialect == "sqlite":
+        fts = f"{table}_fts"
+        exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": fts}
+        ).first()
+        for statement in _sqlite_ddl(table):
+            connection.execute(text(statement))
+        if not exists:
+            connection.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+
+def create_search_index(connection):
+    """Creates the messages index if missing, backfilling it from existing messages."""
+    _create_index(connection, "messages")
+
+
+def create_archive_search_index(connection):
+    """Creates the messages_archive index if missing, backfilling it from archived messages."""
+    _create_index(connection, "messages_archive")
+
+
+def _fts5_query(query: str) -> str:
+    # Each word becomes a quoted FTS5 string, so user input cannot use the
+    # query syntax; the words are ANDed, the last one as a prefix.
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _snippet_html(snippet: str) -> str:
+    return html.escape(snippet).replace(MATCH_START, SNIPPET_START).replace(MATCH_STOP, SNIPPET_STOP)
+
+
+def _search_postgresql(db: Session, query: str, room_id: Optional[str], limit: int, offset: int):
+    # Ranks and pages on each table's index first, then builds headlines for
+    # the page only, since ts_headline has to re-parse each document.
+    room_filter = "AND m.room_id = :room_id" if room_id is not None else ""
+    arms = " UNION ALL ".join(f"""(
+            SELECT m.id, m.room_id, m.sender, m.content, m.timestamp, m.seq,
+                   ts_rank_cd(m.content_tsv, q.query) AS rank
+            FROM {table} m, q
+            WHERE m.content_tsv @@ q.query {room_filter}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT :window
+        )""" for table in SEARCH_TABLES)
+    statement = text(f"""
+        WITH q AS (SELECT websearch_to_tsquery('{SEARCH_LANGUAGE}', :query) AS query),
+        hits AS (
+            {arms}
+            ORDER BY rank DESC, id DESC
+            LIMIT :limit OFFSET :offset
+        )
+        SELECT hits.id, hits.room_id, hits.sender, hits.content, hits.timestamp, hits.seq, hits.rank,
+               ts_headline('{SEARCH_LANGUAGE}', hits.content, q.query,
+                           'StartSel={MATCH_START}, StopSel={MATCH_STOP}, MaxWords=24, MinWords=8') AS snippet
+        FROM hits, q
+        ORDER BY hits.rank DESC, hits.id DESC
+    """)
+    return db.execute(statement, {"query": query, "room_id": room_id, "limit": limit, "offset": offset,
+                                  "window": limit + offset})
+
+
+def _search_sqlite(db: Session, query: str, room_id: Optional[str], limit: int, offset: int):
+    match = _fts5_query(query)
+    if not match:
+        return []
+    room_filter = "AND m.room_id = :room_id" if room_id is not None else ""
+    # bm25() is lower for better matches; it is negated so rank sorts the
+    # same way as on PostgreSQL. Each table contributes at most a page's
+    # worth of its best matches, so snippets are built for those rows only.
+    arms = " UNION ALL ".join(f"""SELECT * FROM (
+            SELECT m.id, m.room_id, m.sender, m.content, m.timestamp, m.seq, -bm25({table}_fts) AS rank,
+                   snippet({table}_fts, 0, '{MATCH_START}', '{MATCH_STOP}', '...', 16) AS snippet
+            FROM {table}_fts
+            JOIN {table} m ON m.id = {table}_fts.rowid
+            WHERE {table}_fts MATCH :query {room_filter}
+            ORDER BY rank DESC, m.id DESC
+            LIMIT :window
+        )""" for table in SEARCH_TABLES)
+    statement = text(f"""
+        {arms}
+        ORDER BY rank DESC, id DESC
+        LIMIT :limit OFFSET :offset
+    """)
+    return db.execute(statement, {"query": match, "room_id": room_id, "limit": limit, "offset": offset,
+                                  "window": limit + offset})
+
+
+def search_messages(db: Session, query: str, room_id: Optional[str] = None,
+                    limit: int = 20, offset: int = 0) -> List[schemas.MessageSearchResult]:
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        rows = _search_postgresql(db, query, room_id, limit, offset)
+    elif dialect == "sqlite":
+        rows = _search_sqlite(db, query, room_id, limit, offset)
+    else:
+        raise NotImplementedError(f"Full-text search is not supported on {dialect}.")
+    results = []
+    for row in rows:
+        result = dict(row._mapping)
+        result["snippet"] = _snippet_html(result["snippet"])
+        results.append(schemas.MessageSearchResult.model_validate(result))
+    return results
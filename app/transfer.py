@@ -0,0 +1,198 @@
+import csv
+import io
+import os
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional
+
+from sqlalchemy.orm import Session
+
+from .database import SessionLocal
+from . import crud, models
+from .auth import get_pwd_context, hash_password
+from .response_cache import response_cache
+from .ws.encoding import json_dumps, json_loads
+
+# Bulk export and import of rooms and messages, for backups, migrations and
+# seeding. Exports read through server-side cursors in chunks and imports
+# write batched executemany INSERTs, so memory stays flat at any size.
+#
+# NDJSON holds everything in one file, one record per line with a "type" of
+# "room", "message" or "archived_message"; rooms come first. CSV holds one
+# table per file. Room passwords are exported as their bcrypt hashes and
+# imported as-is; plain-text passwords in an import are hashed.
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+
+NDJSON = "ndjson"
+CSV = "csv"
+FORMATS = (NDJSON, CSV)
+
+ROOMS = "rooms"
+MESSAGES = "messages"
+ARCHIVED_MESSAGES = "archived_messages"
+TABLES = (ROOMS, MESSAGES, ARCHIVED_MESSAGES)
+
+RECORD_TYPES = {ROOMS: "room", MESSAGES: "message", ARCHIVED_MESSAGES: "archived_message"}
+MODELS = {ROOMS: models.Room, MESSAGES: models.Message, ARCHIVED_MESSAGES: models.ArchivedMessage}
+COLUMNS = {
+    ROOMS: ["id", "username", "password", "last_seq"],
+    MESSAGES: ["id", "room_id", "sender", "content", "timestamp", "seq"],
+    ARCHIVED_MESSAGES: ["id", "room_id", "sender", "content", "timestamp", "seq"],
+}
+INTEGER_COLUMNS = {
+    ROOMS: {"last_seq"},
+    MESSAGES: {"id", "seq"},
+    ARCHIVED_MESSAGES: {"id", "seq"},
+}
+
+
+def _plain(row: dict) -> dict:
+    timestamp = row.get("timestamp")
+    if isinstance(timestamp, datetime):
+        row["timestamp"] = timestamp.isoformat()
+    return row
+
+
+def export_ndjson(db: Session, tables: Iterable[str] = TABLES) -> Iterator[str]:
+    """Yields one chunk of NDJSON per crud.STREAM_CHUNK_SIZE rows."""
+    for table in tables:
+        record_type = RECORD_TYPES[table]
+        lines: List[str] = []
+        for row in crud.iter_table_rows(db, MODELS[table], COLUMNS[table]):
+            lines.append(json_dumps({"type": record_type, **_plain(dict(row))}))
+            if len(lines) >= crud.STREAM_CHUNK_SIZE:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+
+def export_csv(db: Session, table: str) -> Iterator[str]:
+    """Yields the header, then one chunk of CSV per crud.STREAM_CHUNK_SIZE rows."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS[table])
+    writer.writeheader()
+    count = 0
+    for row in crud.iter_table_rows(db, MODELS[table], COLUMNS[table]):
+        writer.writerow(_plain(dict(row)))
+        count += 1
+        if count % crud.STREAM_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class Importer:
+    """Collects records and writes them in batches of batch_size per table.
+
+    add() is cheap and returns True once a batch is due; flush() and finish()
+    hit the database, so async callers run them in the threadpool. Ids and
+    seqs are kept when given; messages without a seq are numbered after the
+    room's current last_seq. finish() moves room counters and last messages
+    and, on PostgreSQL, the id sequence past the imported rows.
+    """
+
+    def __init__(self, batch_size: int = IMPORT_BATCH_SIZE, session_factory=SessionLocal):
+        self.batch_size = batch_size
+        self._session_factory = session_factory
+        self._pending = {table: [] for table in TABLES}
+        self._room_seqs: dict[str, int] = {}
+        self.counts = {table: 0 for table in TABLES}
+
+    def add(self, table: str, record: dict) -> bool:
+        row = {}
+        for column in COLUMNS[table]:
+            value = record.get(column)
+            if value is None or value == "":
+                continue
+            if column in INTEGER_COLUMNS[table]:
+                value = int(value)
+            elif column == "timestamp" and isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            row[column] = value
+        self._pending[table].append(row)
+        return len(self._pending[table]) >= self.batch_size
+
+    def add_ndjson_line(self, line) -> bool:
+        if not line.strip():
+            return False
+        record = json_loads(line)
+        table = next((table for table, name in RECORD_TYPES.items() if name == record.get("type")), None)
+        if table is None:
+            raise ValueError(f"Unknown record type {record.get('type')!r}.")
+        return self.add(table, record)
+
+    def flush(self):
+        db = self._session_factory()
+        try:
+            # Rooms first, so messages in the same batch can reference them.
+            for table in TABLES:
+                rows, self._pending[table] = self._pending[table], []
+                if not rows:
+                    continue
+                if table == ROOMS:
+                    self._prepare_rooms(rows)
+                else:
+                    self._prepare_messages(db, rows)
+                crud.bulk_insert_rows(db, MODELS[table], rows)
+                self.counts[table] += len(rows)
+            db.commit()
+            if response_cache is not None:
+                response_cache.reset()
+        finally:
+            db.close()
+
+    def finish(self) -> dict:
+        self.flush()
+        db = self._session_factory()
+        try:
+            crud.sync_room_last_seqs(db)
+            crud.sync_room_last_messages(db)
+            crud.sync_message_id_sequence(db)
+            db.commit()
+        finally:
+            db.close()
+        return dict(self.counts)
+
+    def _prepare_rooms(self, rows: List[dict]):
+        for row in rows:
+            if get_pwd_context().identify(row["password"]) is None:
+                row["password"] = hash_password(row["password"])
+            row.setdefault("last_seq", 0)
+
+    def _prepare_messages(self, db: Session, rows: List[dict]):
+        for row in rows:
+            if "seq" not in row:
+                room_id = row["room_id"]
+                if room_id not in self._room_seqs:
+                    self._room_seqs[room_id] = crud.get_room_last_seq(db, room_id)
+                self._room_seqs[room_id] += 1
+                row["seq"] = self._room_seqs[room_id]
+            row.setdefault("timestamp", datetime.now())
+
+
+def import_ndjson(lines: Iterable, importer: Optional[Importer] = None) -> dict:
+    importer = importer or Importer()
+    for line in lines:
+        if importer.add_ndjson_line(line):
+            importer.flush()
+    return importer.finish()
+
+
+def import_csv(lines: Iterable[str], table: str, importer: Optional[Importer] = None) -> dict:
+    importer = importer or Importer()
+    for record in csv.DictReader(lines):
+        if importer.add(table, record):
+            importer.flush()
+    return importer.finish()
+
+
+def import_file(lines: Iterable, format: str = NDJSON, table: Optional[str] = None,
+                importer: Optional[Importer] = None) -> dict:
+    if format == CSV:
+        if table is None:
+            raise ValueError("CSV imports need the table they hold.")
+        return import_csv(lines, table, importer)
+    return import_ndjson(lines, importer)
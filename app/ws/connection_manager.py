@@ -1,37 +1,263 @@
-from typing import List
-from fastapi import WebSocket, WebSocketDisconnect
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, List, Optional, Set, Tuple
+from fastapi import WebSocket, WebSocketDisconnect, status
+from .pubsub import create_broker, InMemoryBroker
+from .encoding import Frame, JsonCodec, json_codec
+from ..metrics import BROADCAST_SECONDS, BROADCAST_RECIPIENTS, gauge
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-        self.room_connections: dict[str, List[WebSocket]] = {}
-
-    async def connect(self, websocket: WebSocket, room_id: str):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        if room_id not in self.room_connections:
-            self.room_connections[room_id] = []
-        self.room_connections[room_id].append(websocket)
-        print(f"WebSocket connected to room {room_id}. Total connections: {len(self.active_connections)}")
-
-
-    def disconnect(self, websocket: WebSocket, room_id: str):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if room_id in self.room_connections and websocket in self.room_connections[room_id]:
-            self.room_connections[room_id].remove(websocket)
-            if not self.room_connections[room_id]: 
-                del self.room_connections[room_id]
-        print(f"WebSocket disconnected from room {room_id}. Total connections: {len(self.active_connections)}")
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# "drop_oldest" discards the oldest queued frame for a full queue,
+# "disconnect" closes the slow consumer instead.
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+WS_BACKPRESSURE_POLICY = os.getenv("WS_BACKPRESSURE_POLICY", DROP_OLDEST)
+if WS_BACKPRESSURE_POLICY not in (DROP_OLDEST, DISCONNECT):
+    raise ValueError(f"Unknown WS_BACKPRESSURE_POLICY {WS_BACKPRESSURE_POLICY!r}; "
+                     f"expected {DROP_OLDEST!r} or {DISCONNECT!r}.")
+
+# Broker channel for a room's presence and typing frames is PRESENCE_PREFIX +
+# room_id. They reach the room's sockets and the sockets registered under
+# PRESENCE_WATCHERS, i.e. the admin presence feed.
+PRESENCE_PREFIX = "presence:"
+PRESENCE_WATCHERS = PRESENCE_PREFIX + "*"
+# Topic for sockets that follow every room, e.g. the multiplexed admin socket.
+ALL_ROOMS = "*"
+
+logger = logging.getLogger(__name__)
+
+
+async def send_frame(websocket: WebSocket, message: Frame):
+    if isinstance(message, bytes):
+        await websocket.send_bytes(message)
+    else:
         await websocket.send_text(message)
 
+
+class ClientConnection:
+    """A socket with a bounded outbound queue drained by its own writer task."""
+
+    def __init__(self, websocket: WebSocket, room_id: Optional[str], on_close: Callable[["ClientConnection"], None],
+                 codec: JsonCodec = json_codec, max_queue: int = WS_SEND_QUEUE_SIZE,
+                 policy: str = WS_BACKPRESSURE_POLICY, user: Optional[Tuple[str, str]] = None):
+        self.websocket = websocket
+        self.room_id = room_id
+        # Every topic the socket is registered under, its room_id included.
+        self.topics: Set[str] = set()
+        # (username, role) of the authenticated client, if any.
+        self.user = user
+        self.codec = codec
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+        self._on_close = on_close
+        self._writer: Optional[asyncio.Task] = None
+        # Held so the event loop does not garbage-collect a pending close.
+        self._closer: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def start(self):
+        if self._writer is not None or self.closed:
+            return
+        self._writer = asyncio.create_task(self._drain())
+
+    def enqueue(self, message: Frame) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.policy == DISCONNECT:
+            logger.warning("Disconnecting slow WebSocket consumer room_id=%s queued=%d", self.room_id, self.queue_depth)
+            self._on_close(self)
+            self._closer = asyncio.create_task(self._close_socket(status.WS_1008_POLICY_VIOLATION, "Client too slow."))
+            return False
+
+        self.queue.get_nowait()
+        self.dropped += 1
+        self.queue.put_nowait(message)
+        return True
+
+    async def _drain(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await send_frame(self.websocket, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info("Dropping broken WebSocket room_id=%s error=%s", self.room_id, e)
+            self._on_close(self)
+
+    async def _close_socket(self, code: int, reason: str):
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        self._writer = None
+
+    def stats(self) -> dict:
+        client = self.websocket.client
+        return {
+            "room_id": self.room_id,
+            "username": self.user[0] if self.user else None,
+            "topics": sorted(self.topics),
+            "protocol": self.codec.subprotocol,
+            "client": f"{client.host}:{client.port}" if client else None,
+            "queue_depth": self.queue_depth,
+            "dropped": self.dropped,
+        }
+
+
+class ConnectionManager:
+    def __init__(self, broker=None):
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+        # Topic index: room ids, ALL_ROOMS and PRESENCE_WATCHERS, each mapped
+        # to its subscribers, so a broadcast only visits the sockets that
+        # want it.
+        self.room_connections: dict[str, dict[WebSocket, ClientConnection]] = {}
+        self.broker = broker if broker is not None else InMemoryBroker()
+        # Called with the ClientConnection after it is added or removed.
+        self.on_connect: Optional[Callable[[ClientConnection], None]] = None
+        self.on_disconnect: Optional[Callable[[ClientConnection], None]] = None
+        self._started = False
+
+    async def start(self):
+        if not self._started:
+            await self.broker.start(self._deliver_local)
+            self._started = True
+
+    async def stop(self):
+        if self._started:
+            await self.broker.stop(self._deliver_local)
+            self._started = False
+
+    async def connect(self, websocket: WebSocket, room_id: Optional[str], codec: JsonCodec = json_codec,
+                      subprotocol: Optional[str] = None, paused: bool = False,
+                      user: Optional[Tuple[str, str]] = None):
+        # A paused connection queues broadcasts without sending them until
+        # resume(), leaving the socket free for handshake frames. With no
+        # room_id it starts without topics and picks them with subscribe().
+        await websocket.accept(subprotocol=subprotocol)
+        connection = ClientConnection(websocket, room_id, on_close=self._remove, codec=codec, user=user)
+        self.active_connections[websocket] = connection
+        if room_id is not None:
+            self.subscribe(websocket, room_id)
+        if not paused:
+            connection.start()
+        if self.on_connect is not None:
+            self.on_connect(connection)
+        logger.debug("WebSocket connected room_id=%s total=%d", room_id, len(self.active_connections))
+
+    def resume(self, websocket: WebSocket):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.start()
+
+    def subscribe(self, websocket: WebSocket, topic: str):
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return
+        connection.topics.add(topic)
+        self.room_connections.setdefault(topic, {})[websocket] = connection
+
+    def unsubscribe(self, websocket: WebSocket, topic: str):
+        connection = self.active_connections.get(websocket)
+        if connection is None:
+            return
+        connection.topics.discard(topic)
+        subscribers = self.room_connections.get(topic)
+        if subscribers is not None:
+            subscribers.pop(websocket, None)
+            if not subscribers:
+                del self.room_connections[topic]
+
+    def disconnect(self, websocket: WebSocket, room_id: Optional[str]):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            self._remove(connection)
+        logger.debug("WebSocket disconnected room_id=%s total=%d", room_id, len(self.active_connections))
+
+    def _remove(self, connection: ClientConnection):
+        connection.close()
+        if self.active_connections.get(connection.websocket) is not connection:
+            return
+        for topic in list(connection.topics):
+            self.unsubscribe(connection.websocket, topic)
+        del self.active_connections[connection.websocket]
+        if self.on_disconnect is not None:
+            self.on_disconnect(connection)
+
+    async def send_personal_message(self, message: Frame, websocket: WebSocket):
+        # Queued behind any pending broadcasts so frames stay in order.
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(message)
+        else:
+            await send_frame(websocket, message)
+
     async def broadcast_to_room(self, message: str, room_id: str):
-        if room_id in self.room_connections:
-            for connection in self.room_connections[room_id]:
-                await connection.send_text(message)
+        # Published through the broker so subscribers on every worker get it;
+        # each worker then delivers to its own sockets in _deliver_local.
+        await self.start()
+        await self.broker.publish(room_id, message)
+
+    async def _deliver_local(self, room_id: str, message: str):
+        # Rooms with no sockets on this worker are expected once the broker
+        # fans out to every worker, so they are skipped silently. Enqueueing
+        # never blocks, so a slow socket cannot stall the rest of the room.
+        # The payload is encoded once per codec and the same object is queued
+        # for every socket that uses it.
+        if room_id.startswith(PRESENCE_PREFIX):
+            connections = self._subscribers(room_id[len(PRESENCE_PREFIX):], ALL_ROOMS, PRESENCE_WATCHERS)
         else:
-            print(f"No active connections for room {room_id} to broadcast to.")
+            connections = self._subscribers(room_id, ALL_ROOMS)
+        if not connections:
+            return
+        start = time.perf_counter()
+        encoded: dict[JsonCodec, Frame] = {}
+        for connection in connections:
+            frame = encoded.get(connection.codec)
+            if frame is None:
+                frame = encoded[connection.codec] = connection.codec.from_json(message)
+            connection.enqueue(frame)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+        BROADCAST_RECIPIENTS.inc(amount=len(connections))
+
+    def _subscribers(self, *topics: str) -> List[ClientConnection]:
+        groups = [self.room_connections[topic] for topic in topics if topic in self.room_connections]
+        if len(groups) == 1:
+            return list(groups[0].values())
+        # A socket on several of the topics still gets the frame once.
+        merged: dict[WebSocket, ClientConnection] = {}
+        for group in groups:
+            merged.update(group)
+        return list(merged.values())
+
+    def connection_stats(self, room_id: Optional[str] = None) -> List[dict]:
+        if room_id is not None:
+            connections = self.room_connections.get(room_id, {}).values()
+        else:
+            connections = self.active_connections.values()
+        return [connection.stats() for connection in connections]
+
+manager = ConnectionManager(create_broker())
 
-manager = ConnectionManager()
\ No newline at end of file
+gauge("ws_connections", "Open WebSocket connections on this worker by room or topic.", ("room_id",),
+      collect=lambda: [((room_id,), len(room)) for room_id, room in manager.room_connections.items()])
+gauge("ws_send_queue_frames", "Frames waiting in WebSocket send queues on this worker.",
+      collect=lambda: [((), sum(c.queue_depth for c in manager.active_connections.values()))])
@@ -0,0 +1,98 @@
+import json
+from typing import Any, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+INVALID_FORMAT = "Invalid message format. Requires 'sender' and 'content'."
+ROLE_MISMATCH = "Sender role mismatch with authenticated role."
+INVALID_JSON = "Message must be a valid JSON string."
+
+
+def json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class JsonCodec:
+    """Text frames, JSON. The default when no subprotocol is negotiated."""
+
+    subprotocol = "chat.json"
+    binary = False
+
+    def __init__(self):
+        # The fixed error frames are encoded once, not per send.
+        self.errors = {
+            INVALID_FORMAT: self.error(INVALID_FORMAT),
+            ROLE_MISMATCH: self.error(ROLE_MISMATCH),
+            INVALID_JSON: self.error(INVALID_JSON),
+        }
+
+    def encode(self, obj: Any) -> Frame:
+        return json_dumps(obj)
+
+    def decode(self, data: Frame) -> Any:
+        return json_loads(data)
+
+    def from_json(self, payload: str) -> Frame:
+        # Messages travel between workers as JSON already.
+        return payload
+
+    def error(self, message: str) -> Frame:
+        return self.encode({"type": "error", "message": message})
+
+    def info(self, message: str) -> Frame:
+        return self.encode({"type": "info", "message": message})
+
+
+class MsgPackCodec(JsonCodec):
+    """Binary MessagePack frames, for clients that ask for chat.msgpack."""
+
+    subprotocol = "chat.msgpack"
+    binary = True
+
+    def encode(self, obj: Any) -> Frame:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: Frame) -> Any:
+        if isinstance(data, str):
+            data = data.encode()
+        return msgpack.unpackb(data, raw=False)
+
+    def from_json(self, payload: str) -> Frame:
+        return self.encode(json_loads(payload))
+
+
+json_codec = JsonCodec()
+msgpack_codec = MsgPackCodec() if msgpack is not None else None
+
+CODECS = {codec.subprotocol: codec for codec in (json_codec, msgpack_codec) if codec is not None}
+
+
+def negotiate(requested: List[str]) -> tuple[JsonCodec, Optional[str]]:
+    """Pick the first supported subprotocol the client offered.
+
+    Returns the codec and the subprotocol to accept, which is None for
+    clients that did not ask for one.
+    """
+    for subprotocol in requested:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec, subprotocol
+    return json_codec, None
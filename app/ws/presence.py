@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from .connection_manager import ClientConnection, ConnectionManager, PRESENCE_PREFIX, manager
+from .encoding import json_dumps
+from ..metrics import gauge
+
+# Changes are collected and sent at most once per PRESENCE_FLUSH_MS per room,
+# so a burst of joins, leaves or keystrokes becomes a single frame.
+PRESENCE_FLUSH_MS = int(os.getenv("PRESENCE_FLUSH_MS", "250"))
+# How often this worker renews its shared counters and reaps those of dead
+# workers; keep it well under BROKER_WORKER_TTL_SECONDS.
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("PRESENCE_HEARTBEAT_SECONDS", "10"))
+
+logger = logging.getLogger(__name__)
+
+# (username, role)
+User = Tuple[str, str]
+
+
+def _users(users) -> List[dict]:
+    return [{"username": username, "role": role} for username, role in sorted(users)]
+
+
+class Presence:
+    """Online users per room, from the sockets open on this worker.
+
+    Users are counted per socket, so several tabs keep a user online until
+    the last one closes, and a join or leave costs O(1) however many sockets
+    the room has. Deltas and typing notices are published through the
+    manager's broker on the room's presence channel, reaching the room's
+    sockets and every admin presence watcher on all workers. Snapshots only
+    cover this worker. Nothing here touches the database.
+
+    Whether a user came online or went offline is decided across workers:
+    each worker adds its users to a counter shared through the broker, one
+    per room, and a delta is only sent when a user's count goes from 0 to 1
+    or back. A user with sockets on two workers stays online until both
+    close. A heartbeat keeps this worker's counts alive; once a worker
+    misses them for the broker's TTL its counts are removed by the next
+    worker to beat, which announces the users left with no socket as gone.
+    """
+
+    def __init__(self, manager: ConnectionManager, flush_ms: int = PRESENCE_FLUSH_MS,
+                 heartbeat_seconds: float = PRESENCE_HEARTBEAT_SECONDS):
+        self.manager = manager
+        self.flush_interval = flush_ms / 1000
+        self.heartbeat_interval = heartbeat_seconds
+        self._online: Dict[str, Dict[User, int]] = {}
+        # Users this worker has added to the shared counters, to turn local
+        # changes into counter updates.
+        self._counted: Dict[str, Set[User]] = {}
+        self._changed: Dict[str, Set[User]] = {}
+        self._typing: Dict[str, Set[str]] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            # Registers this worker with the broker before anything is counted.
+            await self.beat()
+            self.manager.on_connect = self.connected
+            self.manager.on_disconnect = self.disconnected
+            self._task = asyncio.create_task(self._run())
+            self._heartbeat = asyncio.create_task(self._run_heartbeat())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        self.manager.on_connect = self.manager.on_disconnect = None
+        # Takes this worker's users out of the shared counters, so users
+        # with no socket on another worker are announced as gone.
+        counted, self._counted = self._counted, {}
+        try:
+            for room_id, users in counted.items():
+                left = {user for user in users if await self._count(room_id, user, -1) <= 0}
+                if left:
+                    await self._publish(room_id, {"type": "presence", "room_id": room_id, "joined": [],
+                                                  "left": _users(left)})
+        except Exception:
+            logger.exception("Error removing presence on shutdown")
+
+    def connected(self, connection: ClientConnection):
+        # Watchers and multiplexed sockets follow rooms without being in one.
+        if connection.user is None or connection.room_id is None or connection.room_id.startswith(PRESENCE_PREFIX):
+            return
+        room = self._online.setdefault(connection.room_id, {})
+        room[connection.user] = room.get(connection.user, 0) + 1
+        self._mark(connection.room_id, connection.user)
+
+    def disconnected(self, connection: ClientConnection):
+        room = self._online.get(connection.room_id)
+        if connection.user is None or room is None or connection.user not in room:
+            return
+        room[connection.user] -= 1
+        if room[connection.user] == 0:
+            del room[connection.user]
+            if not room:
+                del self._online[connection.room_id]
+        self._mark(connection.room_id, connection.user)
+
+    def typing(self, room_id: str, username: str):
+        self._typing.setdefault(room_id, set()).add(username)
+        self._wake.set()
+
+    def online(self, room_id: str) -> List[dict]:
+        return _users(self._online.get(room_id, {}))
+
+    def snapshot(self, room_id: Optional[str] = None) -> dict:
+        rooms = [room_id] if room_id is not None else list(self._online)
+        return {"type": "presence_snapshot", "rooms": {room: self.online(room) for room in rooms}}
+
+    @property
+    def online_users(self) -> int:
+        return sum(len(room) for room in self._online.values())
+
+    def _mark(self, room_id: str, user: User):
+        self._changed.setdefault(room_id, set()).add(user)
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            # Let changes gather for one interval before sending anything.
+            await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Error publishing presence updates")
+
+    async def flush(self):
+        changed, self._changed = self._changed, {}
+        typing, self._typing = self._typing, {}
+        for room_id, users in changed.items():
+            online = self._online.get(room_id, {})
+            counted = self._counted.setdefault(room_id, set())
+            joined, left = set(), set()
+            # A user who joined and left within one interval cancels out.
+            for user in users:
+                if user in online and user not in counted:
+                    counted.add(user)
+                    if await self._count(room_id, user, 1) == 1:
+                        joined.add(user)
+                elif user not in online and user in counted:
+                    counted.discard(user)
+                    if await self._count(room_id, user, -1) <= 0:
+                        left.add(user)
+            if not counted:
+                del self._counted[room_id]
+            if joined or left:
+                await self._publish(room_id, {"type": "presence", "room_id": room_id,
+                                              "joined": _users(joined), "left": _users(left)})
+        for room_id, usernames in typing.items():
+            await self._publish(room_id, {"type": "typing", "room_id": room_id, "users": sorted(usernames)})
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.beat()
+            except Exception:
+                logger.exception("Error refreshing presence counters")
+
+    async def beat(self):
+        reaped, released = await self.manager.broker.refresh_counters()
+        left: Dict[str, Set[User]] = {}
+        for name, member in released:
+            if name.startswith(PRESENCE_PREFIX):
+                role, username = member.split(":", 1)
+                left.setdefault(name[len(PRESENCE_PREFIX):], set()).add((username, role))
+        joined: Dict[str, Set[User]] = {}
+        if reaped:
+            # This worker was taken for dead; its users are counted again. A
+            # user released just now and counted again never went offline.
+            for room_id, users in self._counted.items():
+                for user in users:
+                    if await self._count(room_id, user, 1) == 1:
+                        if user in left.get(room_id, ()):
+                            left[room_id].discard(user)
+                        else:
+                            joined.setdefault(room_id, set()).add(user)
+        for room_id in set(left) | set(joined):
+            if left.get(room_id) or joined.get(room_id):
+                await self._publish(room_id, {"type": "presence", "room_id": room_id,
+                                              "joined": _users(joined.get(room_id, ())),
+                                              "left": _users(left.get(room_id, ()))})
+
+    async def _count(self, room_id: str, user: User, amount: int) -> int:
+        username, role = user
+        # The role never contains ":", so the member names one user.
+        return await self.manager.broker.add_to_counter(PRESENCE_PREFIX + room_id, f"{role}:{username}", amount)
+
+    async def _publish(self, room_id: str, frame: dict):
+        await self.manager.broadcast_to_room(json_dumps(frame), PRESENCE_PREFIX + room_id)
+
+
+presence = Presence(manager)
+
+gauge("presence_online_users", "Users with at least one open socket on this worker.",
+      collect=lambda: [((), presence.online_users)])
@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Called with (room_id, message) for every message published to any room.
+MessageHandler = Callable[[str, str], Awaitable[None]]
+
+BROADCAST_URL = os.getenv("BROADCAST_URL")
+# A worker that has not refreshed its shared counters for this long is taken
+# for dead, and what it added to them is taken out again.
+BROKER_WORKER_TTL_SECONDS = int(os.getenv("BROKER_WORKER_TTL_SECONDS", "30"))
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryBroker:
+    """Delivers published messages to handlers in this process.
+
+    This is the default single-worker backend. Sharing one instance between
+    several ConnectionManagers behaves like several workers attached to the
+    same external broker, so fan-out can be exercised without Redis.
+    """
+
+    def __init__(self):
+        self._handlers: List[MessageHandler] = []
+        self._counters: Dict[str, Dict[str, int]] = {}
+
+    async def start(self, handler: MessageHandler):
+        if handler not in self._handlers:
+            self._handlers.append(handler)
+
+    async def stop(self, handler: MessageHandler):
+        if handler in self._handlers:
+            self._handlers.remove(handler)
+
+    async def publish(self, room_id: str, message: str):
+        for handler in list(self._handlers):
+            await handler(room_id, message)
+
+    async def add_to_counter(self, name: str, member: str, amount: int) -> int:
+        """Adds amount to a counter shared by every worker; returns the new
+        value. Counters that reach zero are removed."""
+        counter = self._counters.setdefault(name, {})
+        value = counter.get(member, 0) + amount
+        if value > 0:
+            counter[member] = value
+        else:
+            counter.pop(member, None)
+            if not counter:
+                del self._counters[name]
+        return value
+
+    async def refresh_counters(self) -> Tuple[bool, List[Tuple[str, str]]]:
+        """Keeps this worker's counter contributions alive and removes those
+        of dead workers. Returns whether this worker's own contributions had
+        been removed, and the (name, member) counters that dropped to zero.
+        Every worker lives in this process here, so nothing ever expires."""
+        return False, []
+
+
+class RedisBroker:
+    """Fans messages out to every worker through Redis pub/sub.
+
+    Each worker pattern-subscribes to all room channels and delivers to its
+    own sockets, including messages it published itself. When the connection
+    drops, the listener reconnects and subscribes again with exponential
+    backoff; messages published meanwhile are not delivered to this worker.
+
+    Shared counters are hashes with one field per member. Each worker also
+    records what it added in a hash of its own and keeps a liveness key with
+    a TTL. refresh_counters() renews that key and subtracts the records of
+    workers whose key has expired, so a worker that dies without stopping
+    does not leave its members counted for good. It has to be called at
+    least once before add_to_counter(), to register the worker.
+    """
+
+    CHANNEL_PREFIX = "chat:room:"
+    COUNTER_PREFIX = "chat:counter:"
+    # Set of registered worker ids, a liveness key per worker, and per worker
+    # a record hash of "<counter name>\n<member>" to the amount it added.
+    WORKERS_KEY = "chat:workers"
+    WORKER_PREFIX = "chat:worker:"
+    RECORD_PREFIX = "chat:counter-record:"
+    # Increments and removes the member at zero in one atomic step, so a
+    # concurrent increment from another worker is never deleted. The
+    # worker's own record changes in the same step.
+    ADD_TO_COUNTER_SCRIPT = """
+        local value = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+        if value <= 0 then redis.call('HDEL', KEYS[1], ARGV[1]) end
+        if redis.call('HINCRBY', KEYS[2], ARGV[3], ARGV[2]) <= 0 then redis.call('HDEL', KEYS[2], ARGV[3]) end
+        return value
+    """
+    # Registers this worker and renews its liveness key, then takes the
+    # records of every worker whose key has expired out of the counters.
+    # A worker that finds itself no longer registered was reaped while it
+    # was still running; what it added since is taken out as well, so the
+    # caller can add its members back from scratch. Returns 1 if that
+    # happened, followed by the name and member of each counter that
+    # dropped to zero.
+    REFRESH_COUNTERS_SCRIPT = """
+        local workers, worker, ttl = KEYS[1], ARGV[1], ARGV[2]
+        local worker_prefix, record_prefix, counter_prefix = ARGV[3], ARGV[4], ARGV[5]
+        local reaped = redis.call('SADD', workers, worker)
+        local result = {reaped}
+        local function release(id)
+            local record = redis.call('HGETALL', record_prefix .. id)
+            for i = 1, #record, 2 do
+                local split = string.find(record[i], '\\n', 1, true)
+                local name, member = string.sub(record[i], 1, split - 1), string.sub(record[i], split + 1)
+                local counter = counter_prefix .. name
+                if redis.call('HINCRBY', counter, member, -tonumber(record[i + 1])) <= 0 then
+                    redis.call('HDEL', counter, member)
+                    table.insert(result, name)
+                    table.insert(result, member)
+                end
+            end
+            redis.call('DEL', record_prefix .. id)
+        end
+        if reaped == 1 then release(worker) end
+        redis.call('SET', worker_prefix .. worker, 1, 'EX', ttl)
+        for _, other in ipairs(redis.call('SMEMBERS', workers)) do
+            if redis.call('EXISTS', worker_prefix .. other) == 0 then
+                release(other)
+                redis.call('SREM', workers, other)
+            end
+        end
+        return result
+    """
+    RECONNECT_MIN_SECONDS = 0.5
+    RECONNECT_MAX_SECONDS = 30.0
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("BROADCAST_URL is set but the 'redis' package is not installed.") from e
+        self._redis = redis.from_url(url)
+        self._worker_id = uuid.uuid4().hex
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self, handler: MessageHandler):
+        if self._listener is not None:
+            return
+        # The first subscription is made here, so a broker that is down at
+        # startup fails the startup.
+        await self._subscribe()
+        self._listener = asyncio.create_task(self._listen(handler))
+
+    async def _subscribe(self):
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.psubscribe(self.CHANNEL_PREFIX + "*")
+
+    async def _close_pubsub(self):
+        if self._pubsub is None:
+            return
+        pubsub, self._pubsub = self._pubsub, None
+        try:
+            await pubsub.close()
+        except Exception:
+            pass
+
+    async def _listen(self, handler: MessageHandler):
+        delay = self.RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                if self._pubsub is None:
+                    await self._subscribe()
+                    logger.info("Resubscribed to broadcasts")
+                async for item in self._pubsub.listen():
+                    delay = self.RECONNECT_MIN_SECONDS
+                    if item["type"] != "pmessage":
+                        continue
+                    room_id = item["channel"].decode()[len(self.CHANNEL_PREFIX):]
+                    try:
+                        await handler(room_id, item["data"].decode())
+                    except Exception:
+                        logger.exception("Error delivering broadcast room_id=%s", room_id)
+                logger.warning("Broadcast subscription ended, reconnecting in %.1fs", delay)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lost broadcast subscription, reconnecting in %.1fs", delay)
+            await self._close_pubsub()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_SECONDS)
+
+    async def stop(self, handler: MessageHandler):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub is not None:
+            try:
+                await self._pubsub.punsubscribe()
+            except Exception:
+                pass
+            await self._close_pubsub()
+        # Whatever this worker still counts is reaped by the next worker to
+        # refresh, as if it had died.
+        try:
+            await self._redis.delete(self.WORKER_PREFIX + self._worker_id)
+        except Exception:
+            pass
+        await self._redis.close()
+
+    async def publish(self, room_id: str, message: str):
+        await self._redis.publish(self.CHANNEL_PREFIX + room_id, message)
+
+    async def add_to_counter(self, name: str, member: str, amount: int) -> int:
+        # One hash per counter name, one field per member.
+        return int(await self._redis.eval(
+            self.ADD_TO_COUNTER_SCRIPT, 2, self.COUNTER_PREFIX + name, self.RECORD_PREFIX + self._worker_id,
+            member, amount, f"{name}\n{member}",
+        ))
+
+    async def refresh_counters(self) -> Tuple[bool, List[Tuple[str, str]]]:
+        result = await self._redis.eval(
+            self.REFRESH_COUNTERS_SCRIPT, 1, self.WORKERS_KEY,
+            self._worker_id, BROKER_WORKER_TTL_SECONDS,
+            self.WORKER_PREFIX, self.RECORD_PREFIX, self.COUNTER_PREFIX,
+        )
+        reaped = bool(result[0])
+        released = [(result[i].decode(), result[i + 1].decode()) for i in range(1, len(result), 2)]
+        return reaped, released
+
+
+def create_broker():
+    if BROADCAST_URL:
+        return RedisBroker(BROADCAST_URL)
+    return InMemoryBroker()
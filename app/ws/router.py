@@ -1,26 +1,63 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Query
+import logging
+import os
+from typing import Optional
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException, status, Query
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from ..database import get_db
-from .. import crud, schemas, auth
-from .connection_manager import manager
-import json
+from ..database import SessionLocal, run_db
+from .. import crud, schemas, auth, persistence, ratelimit
+from ..recent_messages import recent_messages, RECENT_MESSAGES_PER_ROOM
+from .connection_manager import manager, send_frame, ALL_ROOMS, PRESENCE_WATCHERS
+from .presence import presence
+from .encoding import INVALID_FORMAT, ROLE_MISMATCH, INVALID_JSON, negotiate
+
+# Upper bound on messages replayed by a since_seq resume.
+WS_RESUME_MAX_MESSAGES = int(os.getenv("WS_RESUME_MAX_MESSAGES", "1000"))
+# Upper bound on rooms named in one subscribe frame on /ws/admin.
+WS_ADMIN_MAX_ROOMS = int(os.getenv("WS_ADMIN_MAX_ROOMS", "1000"))
 
 ws_router = APIRouter()
+logger = logging.getLogger(__name__)
+
+async def get_recent_payloads(db: Session, room_id: str, count: int):
+    if recent_messages is not None:
+        payloads = await recent_messages.get_or_load(db, room_id, count)
+        if payloads is not None:
+            return payloads
+    messages = await run_db(crud.get_latest_messages_by_room_id, db, room_id, count)
+    return [schemas.MessageResponse.model_validate(message).model_dump_json() for message in messages]
+
+async def resume_from_seq(websocket: WebSocket, codec, room_id: str, since_seq: int):
+    # Reads the primary: a lagging replica would drop messages for good once
+    # live delivery takes over.
+    messages = await run_db(crud.get_messages_since_seq, SessionLocal(), room_id, since_seq,
+                            limit=WS_RESUME_MAX_MESSAGES + 1)
+    for message in messages[:WS_RESUME_MAX_MESSAGES]:
+        await send_frame(websocket, codec.from_json(schemas.MessageResponse.model_validate(message).model_dump_json()))
+    if len(messages) > WS_RESUME_MAX_MESSAGES:
+        last_seq = messages[WS_RESUME_MAX_MESSAGES - 1].seq
+        await send_frame(websocket, codec.info(
+            f"Resume truncated after seq {last_seq}; fetch the rest with since_seq={last_seq}."
+        ))
 
 @ws_router.websocket("/ws/chat/{room_id}")
 async def websocket_endpoint(
     websocket: WebSocket,
     room_id: str,
     token: str = Query(...),
-    db: Session = Depends(get_db)
+    replay: int = Query(0, ge=0, le=RECENT_MESSAGES_PER_ROOM),
+    since_seq: Optional[int] = Query(None, ge=0)
 ):
+    # Sockets live for minutes or hours, so instead of one session for the
+    # whole connection every database call opens its own short-lived session
+    # and returns the pooled connection when it finishes.
     try:
-        current_user_data = auth.get_current_user(token=token, db=db)
+        current_user_data = await run_in_threadpool(auth.get_current_user, token=token, db=SessionLocal())
         username = current_user_data["username"]
         role = current_user_data["role"]
         authenticated_room_id = current_user_data["room_id"]
 
-        room = crud.get_room_by_id(db, room_id)
+        room = await run_db(crud.get_room_by_id, SessionLocal(), room_id)
         if not room:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Room not found.")
             return
@@ -29,48 +66,230 @@ async def websocket_endpoint(
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Not authorized to access this room.")
             return
 
-        await manager.connect(websocket, room_id)
-        print(f"User {username} ({role}) connected to WebSocket for room {room_id}")
-        await manager.send_personal_message(json.dumps({"type": "info", "message": f"Connected to room {room_id} as {username} ({role})."}), websocket)
+        codec, subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+        # Subscribed but paused: live messages queue up while the handshake
+        # frames go out directly, so nothing saved in between is lost and
+        # replayed messages are never sent after newer live ones. A message
+        # may arrive both ways; clients de-duplicate on seq.
+        await manager.connect(websocket, room_id, codec=codec, subprotocol=subprotocol, paused=True,
+                              user=(username, role))
+        logger.info("WebSocket user connected username=%s role=%s room_id=%s", username, role, room_id)
 
         try:
+            await send_frame(websocket, codec.info(f"Connected to room {room_id} as {username} ({role})."))
+            await send_frame(websocket, codec.encode(presence.snapshot(room_id)))
+            if since_seq is not None:
+                await resume_from_seq(websocket, codec, room_id, since_seq)
+            elif replay:
+                for payload in await get_recent_payloads(SessionLocal(), room_id, replay):
+                    await send_frame(websocket, codec.from_json(payload))
+            manager.resume(websocket)
+
+            frame_bucket = ratelimit.ws_frames.bucket()
             while True:
-                data = await websocket.receive_text()
+                frame = await websocket.receive()
+                if frame["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(frame.get("code", status.WS_1000_NORMAL_CLOSURE))
+                if ratelimit.ws_frames.take(frame_bucket):
+                    logger.warning("Closing flooding WebSocket username=%s room_id=%s", username, room_id)
+                    manager.disconnect(websocket, room_id)
+                    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Rate limit exceeded.")
+                    return
+                data = frame.get("text") if frame.get("text") is not None else frame.get("bytes")
                 try:
-                    message_data = json.loads(data)
+                    try:
+                        message_data = codec.decode(data)
+                    except ValueError:
+                        # json, orjson and msgpack decode errors are all ValueErrors.
+                        await manager.send_personal_message(codec.errors[INVALID_JSON], websocket)
+                        continue
+                    if not isinstance(message_data, dict):
+                        await manager.send_personal_message(codec.errors[INVALID_FORMAT], websocket)
+                        continue
+                    if message_data.get("type") == "typing":
+                        # Ephemeral: coalesced and broadcast, never saved.
+                        presence.typing(room_id, username)
+                        continue
                     sender_role_from_client = message_data.get("sender")
                     content = message_data.get("content")
 
                     if not sender_role_from_client or not content:
-                        await manager.send_personal_message(json.dumps({"type": "error", "message": "Invalid message format. Requires 'sender' and 'content'."}), websocket)
+                        await manager.send_personal_message(codec.errors[INVALID_FORMAT], websocket)
                         continue
 
                     if sender_role_from_client != role:
-                        await manager.send_personal_message(json.dumps({"type": "error", "message": "Sender role mismatch with authenticated role."}), websocket)
+                        await manager.send_personal_message(codec.errors[ROLE_MISMATCH], websocket)
                         continue
 
                     message_to_create = schemas.MessageCreate(room_id=room_id, sender=role, content=content)
-                    db_message = crud.create_message(db, message_to_create)
-                    
-                    response_message = schemas.MessageResponse.model_validate(db_message).model_dump_json()
+                    _, response_message = await persistence.save_and_encode_message(SessionLocal(), message_to_create)
                     await manager.broadcast_to_room(response_message, room_id)
 
-                except json.JSONDecodeError:
-                    await manager.send_personal_message(json.dumps({"type": "error", "message": "Message must be a valid JSON string."}), websocket)
                 except Exception as e:
-                    print(f"Error processing websocket message: {e}")
-                    await manager.send_personal_message(json.dumps({"type": "error", "message": f"Server error: {e}"}), websocket)
+                    logger.exception("Error processing websocket message room_id=%s", room_id)
+                    await manager.send_personal_message(codec.error(f"Server error: {e}"), websocket)
 
         except WebSocketDisconnect:
             manager.disconnect(websocket, room_id)
-            print(f"User {username} ({role}) disconnected from room {room_id}")
+            logger.info("WebSocket user disconnected username=%s role=%s room_id=%s", username, role, room_id)
         except Exception as e:
-            print(f"Unexpected error in websocket_endpoint inner loop for {username}: {e}")
+            logger.exception("Unexpected error in websocket_endpoint inner loop username=%s", username)
+            manager.disconnect(websocket, room_id)
             await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason=f"An unexpected error occurred: {e}")
 
     except HTTPException as e:
-        print(f"WebSocket authentication error for room {room_id}: {e.detail}")
+        logger.info("WebSocket authentication error room_id=%s detail=%s", room_id, e.detail)
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
     except Exception as e:
-        print(f"Unexpected error during WebSocket connection setup for room {room_id}: {e}")
-        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason=f"An unexpected error occurred during setup: {e}")
\ No newline at end of file
+        logger.exception("Unexpected error during WebSocket connection setup room_id=%s", room_id)
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason=f"An unexpected error occurred during setup: {e}")
+
+@ws_router.websocket("/ws/admin/presence")
+async def admin_presence_endpoint(websocket: WebSocket, token: str = Query(...)):
+    # Sends a snapshot of the rooms on this worker, then every presence and
+    # typing frame from all rooms. Incoming frames are ignored.
+    try:
+        current_user_data = await run_in_threadpool(auth.get_current_user, token=token, db=SessionLocal())
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    if current_user_data["role"] != "admin":
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Admin access required.")
+        return
+
+    codec, subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+    await manager.connect(websocket, PRESENCE_WATCHERS, codec=codec, subprotocol=subprotocol, paused=True)
+    try:
+        await send_frame(websocket, codec.encode(presence.snapshot()))
+        manager.resume(websocket)
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket, PRESENCE_WATCHERS)
+
+def _room_list(message_data: dict):
+    # "rooms" is either ALL_ROOMS or a list of room ids; None if malformed.
+    rooms = message_data.get("rooms")
+    if rooms == ALL_ROOMS:
+        return rooms
+    if (isinstance(rooms, list) and 0 < len(rooms) <= WS_ADMIN_MAX_ROOMS
+            and all(isinstance(room_id, str) for room_id in rooms)):
+        return list(dict.fromkeys(rooms))
+    return None
+
+async def handle_admin_frame(websocket: WebSocket, codec, username: str, message_data: dict):
+    frame_type = message_data.get("type")
+    if frame_type in ("subscribe", "unsubscribe"):
+        rooms = _room_list(message_data)
+        if rooms is None:
+            await manager.send_personal_message(codec.error(
+                f"'rooms' must be \"{ALL_ROOMS}\" or a list of 1 to {WS_ADMIN_MAX_ROOMS} room ids."
+            ), websocket)
+            return
+        if frame_type == "unsubscribe":
+            for topic in [rooms] if rooms == ALL_ROOMS else rooms:
+                manager.unsubscribe(websocket, topic)
+            await manager.send_personal_message(codec.encode({"type": "unsubscribed", "rooms": rooms}), websocket)
+            return
+        if rooms == ALL_ROOMS:
+            manager.subscribe(websocket, ALL_ROOMS)
+            await manager.send_personal_message(codec.encode({"type": "subscribed", "rooms": rooms}), websocket)
+            return
+        existing = set(await run_db(crud.get_existing_room_ids, SessionLocal(), rooms))
+        for room_id in rooms:
+            if room_id in existing:
+                manager.subscribe(websocket, room_id)
+        await manager.send_personal_message(codec.encode({
+            "type": "subscribed",
+            "rooms": [room_id for room_id in rooms if room_id in existing],
+            "not_found": [room_id for room_id in rooms if room_id not in existing],
+        }), websocket)
+    elif frame_type == "reply":
+        room_id = message_data.get("room_id")
+        content = message_data.get("content")
+        if not isinstance(room_id, str) or not isinstance(content, str) or not content:
+            await manager.send_personal_message(codec.error("A reply requires 'room_id' and 'content'."), websocket)
+            return
+        room = await run_db(crud.get_room_by_id, SessionLocal(), room_id)
+        if not room:
+            await manager.send_personal_message(codec.error("Room not found."), websocket)
+            return
+        message_to_create = schemas.MessageCreate(room_id=room_id, sender="admin", content=content)
+        saved_message, response_message = await persistence.save_and_encode_message(SessionLocal(), message_to_create)
+        await manager.broadcast_to_room(response_message, room_id)
+        # "ref" is the client's own id for the reply, echoed so it can match
+        # the acknowledgement to what it sent.
+        await manager.send_personal_message(codec.encode({
+            "type": "sent", "ref": message_data.get("ref"), "room_id": room_id,
+            "id": saved_message.id, "seq": saved_message.seq,
+        }), websocket)
+    elif frame_type == "typing":
+        if not isinstance(message_data.get("room_id"), str):
+            await manager.send_personal_message(codec.error("Typing requires 'room_id'."), websocket)
+            return
+        presence.typing(message_data["room_id"], username)
+    else:
+        await manager.send_personal_message(codec.error(f"Unknown frame type {frame_type!r}."), websocket)
+
+@ws_router.websocket("/ws/admin")
+async def admin_multiplex_endpoint(websocket: WebSocket, token: str = Query(...)):
+    # One admin socket for many rooms. It starts with no rooms and is driven
+    # by frames:
+    #   {"type": "subscribe", "rooms": ["<room_id>", ...]}  or  "rooms": "*"
+    #   {"type": "unsubscribe", "rooms": [...]}             or  "rooms": "*"
+    #   {"type": "reply", "room_id": "...", "content": "...", "ref": ...}
+    #   {"type": "typing", "room_id": "..."}
+    # "*" follows every room, including ones created later, and is tracked
+    # apart from the listed rooms. Messages and presence frames of followed
+    # rooms arrive as they do on /ws/chat, each one once.
+    try:
+        current_user_data = await run_in_threadpool(auth.get_current_user, token=token, db=SessionLocal())
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    if current_user_data["role"] != "admin":
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Admin access required.")
+        return
+    username = current_user_data["username"]
+
+    codec, subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+    await manager.connect(websocket, None, codec=codec, subprotocol=subprotocol, paused=True,
+                          user=(username, "admin"))
+    logger.info("Admin multiplexed WebSocket connected username=%s", username)
+    try:
+        await send_frame(websocket, codec.info(f"Connected as {username} (admin). Subscribe to rooms to follow them."))
+        manager.resume(websocket)
+
+        frame_bucket = ratelimit.ws_frames.bucket()
+        while True:
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            if ratelimit.ws_frames.take(frame_bucket):
+                logger.warning("Closing flooding admin WebSocket username=%s", username)
+                manager.disconnect(websocket, None)
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Rate limit exceeded.")
+                return
+            data = frame.get("text") if frame.get("text") is not None else frame.get("bytes")
+            try:
+                try:
+                    message_data = codec.decode(data)
+                except ValueError:
+                    await manager.send_personal_message(codec.errors[INVALID_JSON], websocket)
+                    continue
+                if not isinstance(message_data, dict):
+                    await manager.send_personal_message(codec.error("Frames must be objects with a 'type'."), websocket)
+                    continue
+                await handle_admin_frame(websocket, codec, username, message_data)
+            except Exception as e:
+                logger.exception("Error processing admin websocket frame username=%s", username)
+                await manager.send_personal_message(codec.error(f"Server error: {e}"), websocket)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        manager.disconnect(websocket, None)
+        logger.info("Admin multiplexed WebSocket disconnected username=%s", username)
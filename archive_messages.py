@@ -0,0 +1,42 @@
+"""Moves old chat messages from messages into messages_archive.
+
+    python archive_messages.py --max-age-days 90
+    python archive_messages.py --max-per-room 5000 --batch-size 500
+
+Defaults come from the RETENTION_* settings in the environment or .env.
+Safe to run while the app is serving; run it from cron to keep the hot
+table small.
+"""
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import retention
+from app.database import create_db_and_tables
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-age-days", type=int, default=retention.RETENTION_MAX_AGE_DAYS,
+                        help="archive messages older than this many days (0: off)")
+    parser.add_argument("--max-per-room", type=int, default=retention.RETENTION_MAX_PER_ROOM,
+                        help="keep only this many newest messages per room (0: off)")
+    parser.add_argument("--batch-size", type=int, default=retention.RETENTION_BATCH_SIZE)
+    parser.add_argument("--pause-ms", type=int, default=retention.RETENTION_BATCH_PAUSE_MS,
+                        help="pause between batches")
+    args = parser.parse_args()
+
+    if not args.max_age_days and not args.max_per_room:
+        parser.error("nothing to do: set --max-age-days or --max-per-room")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    create_db_and_tables()
+    moved = retention.archive_messages(args.max_age_days, args.max_per_room, args.batch_size, args.pause_ms)
+    print(f"Archived {moved} messages.")
+
+
+if __name__ == "__main__":
+    main()
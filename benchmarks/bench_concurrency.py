@@ -0,0 +1,59 @@
+"""Concurrent-request throughput against the in-process ASGI app.
+
+Fires a burst of logins (bcrypt verify + room lookup) while a second set of
+clients hits a DB-backed read endpoint, and reports overall requests/sec
+plus the latency of the cheap requests, which is what suffers when the event
+loop is blocked.
+
+    python benchmarks/bench_concurrency.py --logins 64 --reads 256
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import common  # noqa: F401  (configures the environment before app imports)
+
+import httpx
+
+from app.main import app
+from app.database import create_db_and_tables
+
+
+async def run(logins: int, reads: int):
+    create_db_and_tables()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post("/auth/chat", data={"username": "bench", "password": "pw"})
+        token = response.json()["access_token"]
+        room_id = response.json()["room_id"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        read_latencies = []
+
+        async def login():
+            await client.post("/auth/chat", data={"username": "bench", "password": "pw"})
+
+        async def read():
+            start = time.perf_counter()
+            await client.get(f"/chat/room/{room_id}/messages", headers=headers)
+            read_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[login() for _ in range(logins)], *[read() for _ in range(reads)])
+        elapsed = time.perf_counter() - start
+
+    read_latencies.sort()
+    print(f"requests:        {logins + reads} ({logins} logins, {reads} reads)")
+    print(f"elapsed:         {elapsed:.2f}s")
+    print(f"throughput:      {(logins + reads) / elapsed:.1f} req/s")
+    print(f"read p50:        {statistics.median(read_latencies) * 1000:.1f} ms")
+    print(f"read p99:        {read_latencies[int(len(read_latencies) * 0.99) - 1] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--reads", type=int, default=256)
+    args = parser.parse_args()
+    asyncio.run(run(args.logins, args.reads))
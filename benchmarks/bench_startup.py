@@ -0,0 +1,65 @@
+"""Worker cold start: time to import the app, run startup and serve the
+first authenticated history read, each in a fresh interpreter.
+
+    python benchmarks/bench_startup.py --runs 15
+
+The database is created and migrated first, as on a rolling restart.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+import common  # noqa: F401  (configures the environment before app imports)
+
+from app import crud, auth, schemas
+from app.database import SessionLocal, create_db_and_tables
+
+CHILD = """
+import asyncio, os, sys, time
+start = time.perf_counter()
+from app.main import app
+imported = time.perf_counter()
+import httpx
+
+async def main():
+    async with app.router.lifespan_context(app):
+        ready = time.perf_counter()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.get(f"/chat/room/{os.environ['BENCH_ROOM_ID']}/messages?limit=50",
+                                        headers={"Authorization": "Bearer " + os.environ["BENCH_TOKEN"]})
+            response.raise_for_status()
+            served = time.perf_counter()
+    print(imported - start, ready - imported, served - ready)
+
+asyncio.run(main())
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=15)
+    args = parser.parse_args()
+
+    create_db_and_tables()
+    db = SessionLocal()
+    room_id = crud.create_room(db, schemas.RoomCreate(username="startup-bench", password="pw")).id
+    db.close()
+    env = dict(os.environ, PYTHONPATH=common.ROOT, BENCH_ROOM_ID=room_id,
+               BENCH_TOKEN=auth.create_access_token({"sub": auth.ADMIN_USERNAME, "role": "admin", "room_id": None}))
+
+    samples = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, "-c", CHILD], env=env, cwd=common.ROOT, text=True)
+        samples.append([float(value) * 1000 for value in output.split()[-3:]])
+    imports, startups, first_reads = zip(*samples)
+    print(f"import          p50 {statistics.median(imports):8.1f} ms")
+    print(f"startup         p50 {statistics.median(startups):8.1f} ms")
+    print(f"first read      p50 {statistics.median(first_reads):8.1f} ms")
+    print(f"ready           p50 {statistics.median(i + s for i, s, _ in samples):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Messages/sec for per-message commits versus the write-behind writer.
+
+    python benchmarks/bench_write_behind.py --messages 5000
+"""
+import argparse
+import asyncio
+import time
+
+import common  # noqa: F401  (configures the environment before app imports)
+
+from app import crud, models, schemas
+from app.database import SessionLocal, create_db_and_tables
+from app.persistence import MessageWriter
+
+
+def make_room(db, username: str) -> str:
+    room = models.Room(username=username, password="x")
+    db.add(room)
+    db.commit()
+    return room.id
+
+
+def bench_per_message(count: int) -> float:
+    db = SessionLocal()
+    room_id = make_room(db, "per-message")
+    start = time.perf_counter()
+    for i in range(count):
+        crud.create_message(db, schemas.MessageCreate(room_id=room_id, sender="user", content=f"message {i}"))
+    elapsed = time.perf_counter() - start
+    db.close()
+    return count / elapsed
+
+
+async def bench_write_behind(count: int) -> float:
+    db = SessionLocal()
+    room_id = make_room(db, "write-behind")
+    db.close()
+    writer = MessageWriter()
+    await writer.start()
+    start = time.perf_counter()
+    for i in range(count):
+        await writer.submit(schemas.MessageCreate(room_id=room_id, sender="user", content=f"message {i}"))
+    await writer.stop()
+    elapsed = time.perf_counter() - start
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    args = parser.parse_args()
+    create_db_and_tables()
+    print(f"per-message commit: {bench_per_message(args.messages):10.0f} msg/s")
+    print(f"write-behind:       {asyncio.run(bench_write_behind(args.messages)):10.0f} msg/s")
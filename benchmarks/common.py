@@ -0,0 +1,44 @@
+"""Shared setup for the benchmarks.
+
+Importing this module points the app at a throwaway SQLite database (or at
+BENCH_DATABASE_URL, e.g. a scratch Postgres) before anything from ``app`` is
+imported, so every script must import it first.
+"""
+import os
+import statistics
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_db_file = os.path.join(tempfile.mkdtemp(), "bench.db")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{_db_file}")
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("ADMIN_USERNAME", "admin")
+os.environ.setdefault("ADMIN_PASSWORD_HASHED", "$2b$12$" + "x" * 53)
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# The scenarios hammer one login and one room on purpose.
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+# The history and rooms scenarios repeat the same request; with the response
+# cache on they would time cache hits, not the queries.
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+
+
+def percentile(samples, fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, latencies, **extra) -> dict:
+    result = {
+        "name": name,
+        "samples": len(latencies),
+        "p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+    result.update(extra)
+    return result
@@ -0,0 +1,251 @@
+"""Benchmark suite for the chat API, runnable on a laptop.
+
+Runs against a throwaway SQLite database, or against BENCH_DATABASE_URL when
+that points at a scratch Postgres. Requests go through the in-process ASGI
+app via httpx, so no server needs to be started.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --quick --only history,broadcast
+    python benchmarks/run.py --output new.json --compare results.json
+
+Scenarios:
+    login      /auth/chat throughput for an existing user (bcrypt verify)
+    history    p50/p99 of history reads as a room grows
+    rooms      /admin/rooms with 10k rooms
+    broadcast  fan-out latency with 1, 100 and 1000 subscribers in a room
+
+Results are written as JSON (one entry per measurement, keyed by name) so two
+runs can be compared with --compare.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+from common import ROOT, summarize
+
+import httpx
+from sqlalchemy import insert
+
+from app import crud, auth, models
+from app.database import SessionLocal, create_db_and_tables
+from app.main import app
+from app.ws.connection_manager import ConnectionManager
+from app.ws.pubsub import InMemoryBroker
+
+
+def seed_rooms(count: int, prefix: str, messages_per_room: int = 0) -> list:
+    db = SessionLocal()
+    try:
+        rooms = [models.Room(username=f"{prefix}-{i}", password="x", last_seq=messages_per_room) for i in range(count)]
+        db.add_all(rooms)
+        db.commit()
+        room_ids = [room.id for room in rooms]
+        if messages_per_room:
+            next_id = crud.get_max_message_id(db) + 1
+            rows = []
+            for room_id in room_ids:
+                for j in range(messages_per_room):
+                    rows.append({"id": next_id, "seq": j + 1, "room_id": room_id, "sender": "user",
+                                 "content": f"message {j}", "timestamp": datetime.now()})
+                    next_id += 1
+                if len(rows) >= 10000:
+                    db.execute(insert(models.Message), rows)
+                    rows = []
+            if rows:
+                db.execute(insert(models.Message), rows)
+            crud.sync_room_last_messages(db)
+            db.commit()
+        return room_ids
+    finally:
+        db.close()
+
+
+def admin_headers() -> dict:
+    token = auth.create_access_token({"sub": auth.ADMIN_USERNAME, "role": "admin", "room_id": None})
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def timed_get(client: httpx.AsyncClient, url: str, headers: dict, repeat: int) -> list:
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = await client.get(url, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+    return latencies
+
+
+async def bench_login(client: httpx.AsyncClient, quick: bool) -> list:
+    total, concurrency = (16, 4) if quick else (64, 8)
+    await client.post("/auth/chat", data={"username": "login-bench", "password": "pw"})
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def login():
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/auth/chat", data={"username": "login-bench", "password": "pw"})
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[login() for _ in range(total)])
+    elapsed = time.perf_counter() - start
+    return [summarize("login.existing_user", latencies, concurrency=concurrency, rps=round(total / elapsed, 2))]
+
+
+async def bench_history(client: httpx.AsyncClient, quick: bool) -> list:
+    sizes = (100, 1000) if quick else (100, 1000, 10000, 100000)
+    repeat = 20 if quick else 50
+    headers = admin_headers()
+    results = []
+    for size in sizes:
+        room_id = seed_rooms(1, f"history-{size}", messages_per_room=size)[0]
+        base = f"/chat/room/{room_id}/messages"
+        db = SessionLocal()
+        newest_id = crud.get_latest_messages_by_room_id(db, room_id, 1)[0].id
+        db.close()
+
+        latest = await timed_get(client, f"{base}?limit=50", headers, repeat)
+        results.append(summarize(f"history.latest50.size{size}", latest))
+        paged = await timed_get(client, f"{base}?limit=50&before_id={newest_id}", headers, repeat)
+        results.append(summarize(f"history.before_id50.size{size}", paged))
+        if size <= 10000:
+            full = await timed_get(client, base, headers, max(3, repeat // 10))
+            results.append(summarize(f"history.full.size{size}", full))
+    return results
+
+
+async def bench_rooms(client: httpx.AsyncClient, quick: bool) -> list:
+    count = 1000 if quick else 10000
+    repeat = 5 if quick else 10
+    seed_rooms(count, "rooms", messages_per_room=2)
+    headers = admin_headers()
+    page = await timed_get(client, "/admin/rooms?limit=50", headers, repeat)
+    full = await timed_get(client, "/admin/rooms", headers, repeat)
+    return [
+        summarize(f"admin_rooms.page50.rooms{count}", page),
+        summarize(f"admin_rooms.full.rooms{count}", full),
+    ]
+
+
+class RecordingSocket:
+    client = None
+
+    def __init__(self, received: list):
+        self.received = received
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, message):
+        self.received.append(time.perf_counter())
+
+    async def send_bytes(self, message):
+        self.received.append(time.perf_counter())
+
+    async def close(self, code=None, reason=None):
+        pass
+
+
+async def bench_broadcast(quick: bool) -> list:
+    repeat = 20 if quick else 100
+    payload = json.dumps({"sender": "user", "content": "x" * 100, "id": 1, "room_id": "bench",
+                          "timestamp": datetime.now().isoformat()})
+    results = []
+    for subscribers in (1, 100, 1000):
+        manager = ConnectionManager(InMemoryBroker())
+        await manager.start()
+        received: list = []
+        sockets = [RecordingSocket(received) for _ in range(subscribers)]
+        for socket in sockets:
+            await manager.connect(socket, "bench")
+
+        latencies = []
+        for _ in range(repeat):
+            received.clear()
+            start = time.perf_counter()
+            await manager.broadcast_to_room(payload, "bench")
+            while len(received) < subscribers:
+                await asyncio.sleep(0)
+            latencies.append(max(received) - start)
+
+        for socket in sockets:
+            manager.disconnect(socket, "bench")
+        await manager.stop()
+        results.append(summarize(f"broadcast.subscribers{subscribers}", latencies))
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(scenarios: list, quick: bool) -> list:
+    create_db_and_tables()
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        if "login" in scenarios:
+            results += await bench_login(client, quick)
+        if "history" in scenarios:
+            results += await bench_history(client, quick)
+        if "rooms" in scenarios:
+            results += await bench_rooms(client, quick)
+    if "broadcast" in scenarios:
+        results += await bench_broadcast(quick)
+    return results
+
+
+def compare(results: list, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["results"]}
+    print(f"\n{'benchmark':42} {'p50 before':>11} {'p50 after':>11} {'change':>8}")
+    for entry in results:
+        before = baseline.get(entry["name"])
+        if before is None:
+            continue
+        change = (entry["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0.0
+        print(f"{entry['name']:42} {before['p50_ms']:>9.2f}ms {entry['p50_ms']:>9.2f}ms {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default="login,history,rooms,broadcast",
+                        help="comma-separated scenarios to run")
+    parser.add_argument("--quick", action="store_true", help="smaller data sets, for a smoke run")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="print p50 changes against a previous --output file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.only.split(","), args.quick))
+    for entry in results:
+        extra = f"  {entry['rps']} req/s" if "rps" in entry else ""
+        print(f"{entry['name']:42} p50 {entry['p50_ms']:9.2f} ms  p99 {entry['p99_ms']:9.2f} ms{extra}")
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Applies and lists database schema migrations.
+
+    python migrate.py              # apply every pending migration
+    python migrate.py upgrade --to 3
+    python migrate.py status
+
+Run it before rolling out a release when the app is started with
+DB_AUTO_MIGRATE=false; workers then only check the schema version at
+startup. Uses DATABASE_URL from the environment or .env.
+"""
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import migrations
+from app.database import engine
+
+
+def upgrade(args):
+    applied = migrations.upgrade(engine, target=args.to)
+    for step in applied:
+        print(f"Applied {step.version:04d} {step.name}")
+    if not applied:
+        print("Database is up to date.")
+
+
+def status(args):
+    for version, name, applied_at in migrations.status(engine):
+        state = f"applied {applied_at:%Y-%m-%d %H:%M:%S}" if applied_at else "pending"
+        print(f"{version:04d} {name:40} {state}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+
+    upgrade_parser = commands.add_parser("upgrade", help="apply pending migrations (the default)")
+    upgrade_parser.add_argument("--to", type=int, help="stop after this version")
+    upgrade_parser.set_defaults(func=upgrade)
+
+    status_parser = commands.add_parser("status", help="list migrations and whether they are applied")
+    status_parser.set_defaults(func=status)
+
+    args = parser.parse_args()
+    if args.command is None:
+        args = parser.parse_args(["upgrade"])
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
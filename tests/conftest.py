@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+# Configured before anything imports app, which reads its settings at import
+# time. Each run gets a fresh SQLite database.
+_data_dir = tempfile.mkdtemp(prefix="chat-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite:///{os.path.join(_data_dir, 'test.db')}",
+    "SECRET_KEY": "test-secret",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    "ADMIN_USERNAME": "admin",
+    "ADMIN_PASSWORD_HASHED": "unused",
+})
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(scope="session")
+def admin_headers():
+    from app import crud, auth  # noqa: F401  (crud first: auth and crud import each other)
+
+    token = auth.create_access_token({"sub": "admin", "role": "admin", "room_id": None})
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+from app import crud, models, schemas
+from app.database import SessionLocal
+
+
+def test_changes_wait_for_a_missing_id_to_settle(client, admin_headers):
+    db = SessionLocal()
+    try:
+        room_id = crud.create_room(db, schemas.RoomCreate(username="changes-user", password="pw")).id
+        first, missing, last = (
+            crud.create_message(db, schemas.MessageCreate(room_id=room_id, sender="user", content=content)).id
+            for content in ("one", "two", "three")
+        )
+        # Stands in for a transaction that took an id but has not committed.
+        db.query(models.Message).filter(models.Message.id == missing).delete()
+        db.commit()
+
+        response = client.get("/admin/changes", params={"since_id": first}, headers=admin_headers)
+        assert response.status_code == 200
+        assert response.json() == {"messages": [], "next_since_id": first, "has_more": False}
+
+        settled, has_more = crud.get_message_changes(db, first, 10, datetime.now() + timedelta(seconds=1))
+        assert [message.id for message in settled] == [last]
+        assert not has_more
+    finally:
+        db.close()
+
+
+def test_changes_report_more_when_the_page_is_full(client, admin_headers):
+    db = SessionLocal()
+    try:
+        room_id = crud.create_room(db, schemas.RoomCreate(username="changes-pages", password="pw")).id
+        ids = [crud.create_message(db, schemas.MessageCreate(room_id=room_id, sender="user", content=str(i))).id
+               for i in range(3)]
+    finally:
+        db.close()
+
+    page = client.get("/admin/changes", params={"since_id": ids[0] - 1, "limit": 2}, headers=admin_headers).json()
+    assert [message["id"] for message in page["messages"]] == ids[:2]
+    assert page["has_more"]
+    page = client.get("/admin/changes", params={"since_id": page["next_since_id"], "limit": 2},
+                      headers=admin_headers).json()
+    assert [message["id"] for message in page["messages"]] == ids[2:]
+    assert not page["has_more"]
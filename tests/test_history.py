@@ -0,0 +1,33 @@
+from app import crud, schemas
+from app.database import SessionLocal
+
+
+def test_all_messages_interleave_archive_across_rooms(client):
+    # Room A's archive is newer than room B's oldest hot message, so the
+    # archive cannot simply come first in a cross-room page.
+    db = SessionLocal()
+    try:
+        busy = crud.create_room(db, schemas.RoomCreate(username="history-busy", password="pw")).id
+        quiet = crud.create_room(db, schemas.RoomCreate(username="history-quiet", password="pw")).id
+
+        def post(room_id, content):
+            return crud.create_message(db, schemas.MessageCreate(room_id=room_id, sender="user", content=content)).id
+
+        first_id = post(quiet, "B0")
+        for i in range(1, 11):
+            post(busy, f"A{i}")
+        post(quiet, "B1")
+        assert crud.archive_room_messages(db, busy, max_seq=8) == 8
+
+        expected = ["B0"] + [f"A{i}" for i in range(1, 11)] + ["B1"]
+        # Other tests share the database; only these rooms are compared.
+        contents = lambda messages: [message.content for message in messages if message.room_id in (busy, quiet)]
+
+        assert contents(crud.get_all_messages(db, after_id=first_id - 1)) == expected
+        newest_three = crud.get_all_messages(db, limit=3)
+        assert contents(newest_three) == expected[-3:]
+        assert contents(crud.get_all_messages(db, after_id=first_id, limit=3)) == expected[1:4]
+        assert contents(crud.get_all_messages(db, before_id=newest_three[0].id, limit=2)) == expected[-5:-3]
+        assert contents(crud.iter_all_messages(db, after_id=first_id - 1)) == expected
+    finally:
+        db.close()
@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+from app.ws.connection_manager import ConnectionManager, PRESENCE_WATCHERS
+from app.ws.presence import Presence
+from app.ws.pubsub import InMemoryBroker
+
+
+class FakeWebSocket:
+    client = None
+
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+    async def close(self, code=None, reason=None):
+        pass
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_user_on_two_workers_stays_online_until_both_close():
+    async def scenario():
+        broker = InMemoryBroker()
+        workers = [ConnectionManager(broker), ConnectionManager(broker)]
+        presences = [Presence(worker, flush_ms=0) for worker in workers]
+        for worker, presence in zip(workers, presences):
+            await worker.start()
+            await presence.start()
+        watcher = FakeWebSocket()
+        await workers[0].connect(watcher, None)
+        workers[0].subscribe(watcher, PRESENCE_WATCHERS)
+
+        sockets = [FakeWebSocket(), FakeWebSocket()]
+        for worker, presence, socket in zip(workers, presences, sockets):
+            await worker.connect(socket, "room-a", user=("alice", "user"))
+            await presence.flush()
+        await _settle()
+        assert [frame["joined"] for frame in watcher.sent] == [[{"username": "alice", "role": "user"}]]
+
+        workers[0].disconnect(sockets[0], "room-a")
+        await presences[0].flush()
+        await _settle()
+        assert len(watcher.sent) == 1
+
+        workers[1].disconnect(sockets[1], "room-a")
+        await presences[1].flush()
+        await _settle()
+        assert watcher.sent[-1]["left"] == [{"username": "alice", "role": "user"}]
+
+        for presence in presences:
+            await presence.stop()
+
+    asyncio.run(scenario())
+
+
+def test_stopping_a_worker_announces_its_users_as_gone():
+    async def scenario():
+        broker = InMemoryBroker()
+        worker = ConnectionManager(broker)
+        presence = Presence(worker, flush_ms=0)
+        await worker.start()
+        await presence.start()
+        watcher = FakeWebSocket()
+        await worker.connect(watcher, None)
+        worker.subscribe(watcher, PRESENCE_WATCHERS)
+        await worker.connect(FakeWebSocket(), "room-a", user=("alice", "user"))
+        await presence.flush()
+
+        await presence.stop()
+        await _settle()
+
+        assert watcher.sent[-1]["left"] == [{"username": "alice", "role": "user"}]
+        assert await broker.add_to_counter("presence:room-a", "user:alice", 0) == 0
+
+    asyncio.run(scenario())
+
+
+class ReapingBroker(InMemoryBroker):
+    """Reports another worker's counts as reaped on the next refresh."""
+
+    def __init__(self):
+        super().__init__()
+        self.released = []
+
+    async def refresh_counters(self):
+        released, self.released = self.released, []
+        return False, released
+
+
+def test_heartbeat_announces_users_of_a_dead_worker_as_gone():
+    async def scenario():
+        broker = ReapingBroker()
+        worker = ConnectionManager(broker)
+        presence = Presence(worker, flush_ms=0)
+        await worker.start()
+        await presence.start()
+        watcher = FakeWebSocket()
+        await worker.connect(watcher, None)
+        worker.subscribe(watcher, PRESENCE_WATCHERS)
+
+        broker.released = [("presence:room-a", "user:bob"), ("rate:other", "x")]
+        await presence.beat()
+        await _settle()
+
+        assert watcher.sent == [{"type": "presence", "room_id": "room-a", "joined": [],
+                                 "left": [{"username": "bob", "role": "user"}]}]
+        await presence.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,113 @@
+import asyncio
+
+from app.ws.connection_manager import ClientConnection, ConnectionManager, DISCONNECT
+from app.ws.pubsub import InMemoryBroker
+
+
+class FakeWebSocket:
+    client = None
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.sent = []
+        self.close_code = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, message):
+        if self.fail:
+            raise RuntimeError("connection closed")
+        self.sent.append(message)
+
+    async def send_bytes(self, message):
+        await self.send_text(message)
+
+    async def close(self, code=None, reason=None):
+        self.close_code = code
+
+
+async def _settle():
+    # Lets the per-socket writer tasks drain their queues.
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_broadcast_reaches_every_manager_on_the_broker():
+    async def scenario():
+        broker = InMemoryBroker()
+        first, second = ConnectionManager(broker), ConnectionManager(broker)
+        await first.start()
+        await second.start()
+        local, remote, elsewhere = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        await first.connect(local, "room-a")
+        await second.connect(remote, "room-a")
+        await second.connect(elsewhere, "room-b")
+
+        await first.broadcast_to_room('{"content":"hello"}', "room-a")
+        await _settle()
+
+        assert local.sent == ['{"content":"hello"}']
+        assert remote.sent == ['{"content":"hello"}']
+        assert elsewhere.sent == []
+
+    asyncio.run(scenario())
+
+
+def test_stopped_manager_no_longer_receives():
+    async def scenario():
+        broker = InMemoryBroker()
+        first, second = ConnectionManager(broker), ConnectionManager(broker)
+        await first.start()
+        await second.start()
+        remote = FakeWebSocket()
+        await second.connect(remote, "room-a")
+        await second.stop()
+
+        await first.broadcast_to_room("hello", "room-a")
+        await _settle()
+
+        assert remote.sent == []
+
+    asyncio.run(scenario())
+
+
+def test_broken_socket_is_removed_and_others_still_receive():
+    async def scenario():
+        broker = InMemoryBroker()
+        first, second = ConnectionManager(broker), ConnectionManager(broker)
+        await first.start()
+        await second.start()
+        broken, healthy = FakeWebSocket(fail=True), FakeWebSocket()
+        await second.connect(broken, "room-a")
+        await second.connect(healthy, "room-a")
+
+        await first.broadcast_to_room("one", "room-a")
+        await _settle()
+
+        assert broken not in second.active_connections
+        assert broken not in second.room_connections["room-a"]
+        assert healthy in second.active_connections
+
+        await first.broadcast_to_room("two", "room-a")
+        await _settle()
+
+        assert healthy.sent == ["one", "two"]
+        assert broken.sent == []
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_policy_closes_a_full_queue():
+    async def scenario():
+        socket, closed = FakeWebSocket(), []
+        connection = ClientConnection(socket, "room-a", on_close=closed.append, max_queue=1, policy=DISCONNECT)
+
+        assert connection.enqueue("one")
+        assert not connection.enqueue("two")
+        await connection._closer
+
+        assert closed == [connection]
+        assert socket.close_code == 1008
+
+    asyncio.run(scenario())
@@ -0,0 +1,44 @@
+from app.recent_messages import RecentMessages
+
+
+def _loaded(per_room: int = 5) -> RecentMessages:
+    buffer = RecentMessages(per_room=per_room)
+    buffer.load("room", [], complete=True)
+    return buffer
+
+
+def test_append_ignores_a_message_already_buffered():
+    buffer = _loaded()
+    buffer.append("room", 1, "x1")
+    buffer.append("room", 1, "x1")
+
+    assert buffer.get("room") == ["x1"]
+
+
+def test_append_keeps_messages_in_id_order():
+    buffer = _loaded()
+    for message_id in (1, 3, 2):
+        buffer.append("room", message_id, f"x{message_id}")
+
+    assert buffer.get("room") == ["x1", "x2", "x3"]
+
+
+def test_late_message_in_a_full_buffer_evicts_the_oldest():
+    buffer = _loaded(per_room=3)
+    for message_id in (1, 2, 4):
+        buffer.append("room", message_id, f"x{message_id}")
+    buffer.append("room", 3, "x3")
+
+    assert buffer.get("room", limit=3) == ["x2", "x3", "x4"]
+    assert buffer.get("room") is None
+
+
+def test_late_message_older_than_a_full_buffer_is_not_kept():
+    buffer = _loaded(per_room=2)
+    for message_id in (2, 3):
+        buffer.append("room", message_id, f"x{message_id}")
+    buffer.append("room", 1, "x1")
+
+    assert buffer.get("room", limit=2) == ["x2", "x3"]
+    assert buffer.get("room") is None
+    assert buffer.total_bytes == sum(entry.size for entry in buffer._rooms.values())
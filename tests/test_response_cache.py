@@ -0,0 +1,68 @@
+from app import persistence
+from app.response_cache import response_cache
+
+
+def _login(client, username: str):
+    login = client.post("/auth/chat", data={"username": username, "password": "pw"}).json()
+    return login["room_id"], {"Authorization": f"Bearer {login['access_token']}"}
+
+
+def _post(client, room_id, headers, content: str):
+    response = client.post("/chat/message", json={"room_id": room_id, "sender": "user", "content": content},
+                           headers=headers)
+    assert response.status_code == 200
+
+
+def test_unchanged_history_is_not_modified(client):
+    room_id, headers = _login(client, "cache-etag")
+    _post(client, room_id, headers, "hello")
+
+    first = client.get(f"/chat/room/{room_id}/messages", headers=headers)
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+
+    again = client.get(f"/chat/room/{room_id}/messages", headers={**headers, "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["etag"] == etag
+
+
+def test_new_message_changes_the_etag(client):
+    room_id, headers = _login(client, "cache-write")
+    _post(client, room_id, headers, "one")
+    etag = client.get(f"/chat/room/{room_id}/messages", headers=headers).headers["etag"]
+
+    _post(client, room_id, headers, "two")
+    response = client.get(f"/chat/room/{room_id}/messages", headers={**headers, "If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert [message["content"] for message in response.json()] == ["one", "two"]
+
+
+def test_room_is_bumped_after_the_message_is_buffered(client, monkeypatch):
+    room_id, headers = _login(client, "cache-order")
+    seen = []
+    append = persistence.recent_messages.append
+
+    def recording_append(room, message_id, payload):
+        seen.append(response_cache.version(room))
+        append(room, message_id, payload)
+
+    monkeypatch.setattr(persistence.recent_messages, "append", recording_append)
+    before = response_cache.version(room_id)
+    _post(client, room_id, headers, "hello")
+
+    assert seen == [before]
+    assert response_cache.version(room_id) != before
+
+
+def test_large_history_is_served_gzipped(client):
+    room_id, headers = _login(client, "cache-gzip")
+    for i in range(20):
+        _post(client, room_id, headers, f"message {i} " + "x" * 100)
+
+    response = client.get(f"/chat/room/{room_id}/messages", headers={**headers, "Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 20
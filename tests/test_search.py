@@ -0,0 +1,58 @@
+from app import crud
+from app.database import SessionLocal
+
+
+def _post_to_new_room(client, username: str, contents):
+    login = client.post("/auth/chat", data={"username": username, "password": "pw"}).json()
+    headers = {"Authorization": f"Bearer {login['access_token']}"}
+    for content in contents:
+        response = client.post("/chat/message", json={"room_id": login["room_id"], "sender": "user", "content": content},
+                               headers=headers)
+        assert response.status_code == 200
+    return login["room_id"]
+
+
+def test_search_returns_matching_messages(client, admin_headers):
+    room_id = _post_to_new_room(client, "search-user", ["the quick brown fox", "nothing to see", "quick reply"])
+
+    response = client.get("/admin/search", params={"q": "quick", "room_id": room_id}, headers=admin_headers)
+
+    assert response.status_code == 200
+    results = response.json()
+    assert sorted(result["content"] for result in results) == ["quick reply", "the quick brown fox"]
+    assert sorted(result["seq"] for result in results) == [1, 3]
+    assert all("<mark>quick</mark>" in result["snippet"] for result in results)
+
+
+def test_search_snippet_escapes_message_html(client, admin_headers):
+    room_id = _post_to_new_room(client, "search-html", ["hello <img src=x onerror=alert(1)>"])
+
+    response = client.get("/admin/search", params={"q": "hello", "room_id": room_id}, headers=admin_headers)
+
+    assert response.status_code == 200
+    [result] = response.json()
+    assert result["snippet"] == "<mark>hello</mark> &lt;img src=x onerror=alert(1)&gt;"
+
+
+def test_search_without_matches_is_empty(client, admin_headers):
+    response = client.get("/admin/search", params={"q": "zebra"}, headers=admin_headers)
+
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_search_finds_archived_messages(client, admin_headers):
+    room_id = _post_to_new_room(client, "search-archive", ["archived walrus", "hot walrus", "later"])
+    db = SessionLocal()
+    try:
+        assert crud.archive_room_messages(db, room_id, max_seq=1) == 1
+    finally:
+        db.close()
+
+    response = client.get("/admin/search", params={"q": "walrus", "room_id": room_id}, headers=admin_headers)
+
+    assert response.status_code == 200
+    assert sorted(result["content"] for result in response.json()) == ["archived walrus", "hot walrus"]
+    response = client.get("/admin/search", params={"q": "walrus", "room_id": room_id, "limit": 1, "offset": 1},
+                          headers=admin_headers)
+    assert len(response.json()) == 1
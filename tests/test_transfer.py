@@ -0,0 +1,19 @@
+import json
+
+
+def test_history_includes_imported_messages(client, admin_headers):
+    login = client.post("/auth/chat", data={"username": "import-user", "password": "pw"}).json()
+    room_id = login["room_id"]
+    headers = {"Authorization": f"Bearer {login['access_token']}"}
+    client.post("/chat/message", json={"room_id": room_id, "sender": "user", "content": "one"}, headers=headers)
+    # Loads the room's recent message buffer.
+    assert [m["content"] for m in client.get(f"/chat/room/{room_id}/messages", headers=headers).json()] == ["one"]
+
+    body = json.dumps({"type": "message", "room_id": room_id, "sender": "admin", "content": "two"}) + "\n"
+    response = client.post("/admin/import", content=body, headers=admin_headers)
+    assert response.status_code == 200
+    assert response.json()["messages"] == 1
+
+    history = client.get(f"/chat/room/{room_id}/messages", headers=headers).json()
+    assert [m["content"] for m in history] == ["one", "two"]
+    assert [m["seq"] for m in history] == [1, 2]
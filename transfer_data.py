@@ -0,0 +1,84 @@
+"""Exports and imports chat rooms and messages.
+
+    python transfer_data.py export -o backup.ndjson
+    python transfer_data.py export --format csv --table messages -o messages.csv
+    python transfer_data.py import backup.ndjson
+    python transfer_data.py import rooms.csv --format csv --table rooms
+
+NDJSON carries rooms, messages and archived messages in one file; CSV one
+table per file. Rooms keep their bcrypt password hashes; plain-text
+passwords in an import are hashed. Uses DATABASE_URL from the environment
+or .env.
+
+Stop the app before importing into a database it writes to with
+WRITE_BEHIND on: its writer numbers messages from counters of its own and
+would collide with the imported rows.
+"""
+import argparse
+import sys
+import time
+
+from dotenv import load_dotenv
+from sqlalchemy.exc import IntegrityError
+
+load_dotenv()
+
+from app import transfer
+from app.database import SessionLocal, create_db_and_tables
+
+
+def export(args):
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    db = SessionLocal()
+    try:
+        if args.format == transfer.CSV:
+            chunks = transfer.export_csv(db, args.table)
+        else:
+            chunks = transfer.export_ndjson(db, [args.table] if args.table else transfer.TABLES)
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        db.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+def import_(args):
+    start = time.perf_counter()
+    with open(args.input, newline="") as f:
+        try:
+            counts = transfer.import_file(f, args.format, args.table, transfer.Importer(batch_size=args.batch_size))
+        except IntegrityError as e:
+            sys.exit(f"Import conflicts with existing data: {e.orig}")
+    elapsed = time.perf_counter() - start
+    total = sum(counts.values())
+    print(f"Imported {counts} in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s).", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write rooms and messages to a file or stdout")
+    export_parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    export_parser.set_defaults(run=export)
+
+    import_parser = commands.add_parser("import", help="bulk insert rooms and messages from a file")
+    import_parser.add_argument("input")
+    import_parser.add_argument("--batch-size", type=int, default=transfer.IMPORT_BATCH_SIZE)
+    import_parser.set_defaults(run=import_)
+
+    for command in (export_parser, import_parser):
+        command.add_argument("--format", choices=transfer.FORMATS, default=transfer.NDJSON)
+        command.add_argument("--table", choices=transfer.TABLES,
+                             help="single table; required for CSV")
+
+    args = parser.parse_args()
+    if args.format == transfer.CSV and args.table is None:
+        parser.error("--table is required with --format csv")
+    create_db_and_tables()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()